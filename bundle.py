@@ -0,0 +1,208 @@
+from collections import defaultdict
+import functools
+import json
+import mmap
+import struct
+import zlib
+import numpy as np
+from compact_trie import CompactTrie
+from error_model import ErrorModel
+from language_model import LanguageModel, CompactLanguageModel, UnigramWeights
+from symspell import SymmetricDeleteIndex
+
+BUNDLE_MAGIC = b'SPBUNDLE'
+BUNDLE_VERSION = 1
+# magic, version, sections count
+BUNDLE_HEADER = struct.Struct('<8sII')
+BUNDLE_SECTION_NAME_SIZE = 24
+# name, offset, size, crc32
+BUNDLE_SECTION = struct.Struct('<%dsQQI4x' % BUNDLE_SECTION_NAME_SIZE)
+
+LM_SECTIONS = [('lm.unigram_counts', 'q'), ('lm.unigram_weights', 'd'), ('lm.bigram_offsets', 'q'),
+               ('lm.bigram_successors', 'i'), ('lm.bigram_counts', 'q'), ('lm.bigram_weights', 'd')]
+SYMSPELL_SECTIONS = [('symspell.variant_offsets', 'q'), ('symspell.delete_offsets', 'q'),
+                     ('symspell.delete_word_ids', 'i')]
+
+def save_bundle(filename, language_model, error_model, trie=None, long_word_index=None):
+    """
+    Writes the models to one file of named 8-byte aligned sections with crc32 checksums.
+    The language model is stored as arrays over the sorted vocabulary, the error model as json,
+    the trie in the CompactTrie file format and the SymmetricDeleteIndex as its arrays.
+    """
+    sections = _language_model_sections(language_model)
+    sections.append(('em', json.dumps(_error_model_dict(error_model)).encode('utf-8')))
+    if trie is not None:
+        sections.append(('trie', trie.to_bytes()))
+    if long_word_index is not None:
+        sections.extend(_long_word_index_sections(long_word_index, language_model))
+
+    offset = BUNDLE_HEADER.size + BUNDLE_SECTION.size * len(sections)
+    offset += -offset % 8
+    table = []
+    for name, data in sections:
+        # struct would cut a longer name silently, and it could collide with another section
+        if len(name.encode('ascii')) > BUNDLE_SECTION_NAME_SIZE:
+            raise ValueError(name + ": section name is longer than " + str(BUNDLE_SECTION_NAME_SIZE) + " bytes")
+        table.append(BUNDLE_SECTION.pack(name.encode('ascii'), offset, len(data), zlib.crc32(data)))
+        offset += len(data) + (-len(data) % 8)
+    head = BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(sections)) + b''.join(table)
+    with open(filename, 'wb') as f:
+        f.write(head + b'\0' * (-len(head) % 8))
+        for _, data in sections:
+            f.write(data)
+            f.write(b'\0' * (-len(data) % 8))
+
+def _language_model_sections(language_model):
+    unigram_stat = language_model.unigram_stat
+    words = sorted(w for w, cnt in unigram_stat.items() if cnt > 0)
+    word_ids = {w: i for i, w in enumerate(words)}
+    bigram_offsets = [0]
+    bigram_successors, bigram_counts, bigram_weights = [], [], []
+    for word in words:
+        row = language_model.bigram_stat.get(word)
+        if row:
+            weights = language_model.bigram_weights.get(word)
+            for successor_id, successor, cnt in sorted((word_ids[w], w, cnt) for w, cnt in row.items()
+                                                       if cnt > 0 and w in word_ids):
+                bigram_successors.append(successor_id)
+                bigram_counts.append(cnt)
+                bigram_weights.append(weights.get(successor, 0.0) if weights is not None else 0.0)
+        bigram_offsets.append(len(bigram_successors))
+
+    all_entries = getattr(language_model, 'all_entries', None)
+    if all_entries is None:
+        all_entries = sum(unigram_stat[w] for w in words)
+    meta = {'alpha': language_model.alpha, 'unigram_def_value': float(language_model.unigram_def_value),
+            'all_entries': int(all_entries), 'fingerprint': language_model.fingerprint().hex()}
+    arrays = [[unigram_stat[w] for w in words], [language_model.unigram_weights[w] for w in words],
+              bigram_offsets, bigram_successors, bigram_counts, bigram_weights]
+    sections = [('lm.meta', json.dumps(meta).encode('utf-8')),
+                ('lm.vocabulary', '\n'.join(words).encode('utf-8'))]
+    for (name, typecode), values in zip(LM_SECTIONS, arrays):
+        sections.append((name, np.array(values, dtype=typecode).tobytes()))
+    return sections
+
+def _long_word_index_sections(long_word_index, language_model):
+    settings, words, variant_data, *arrays = long_word_index.to_arrays()
+    settings = dict(settings, fingerprint=language_model.fingerprint().hex())
+    sections = [('symspell.meta', json.dumps(settings).encode('utf-8')), ('symspell.words', words),
+                ('symspell.variants', variant_data)]
+    for (name, typecode), values in zip(SYMSPELL_SECTIONS, arrays):
+        sections.append((name, np.asarray(values, dtype=typecode).tobytes()))
+    return sections
+
+def _error_model_dict(error_model):
+    return {'all_errors': error_model.all_errors,
+            'stat': [[l1, l2, cnt] for l1, row in error_model.stat.items() for l2, cnt in row.items()],
+            'weights': [[l1, l2, float(w)] for l1, row in error_model.weights.items() for l2, w in row.items()]}
+
+class ModelBundle:
+    """
+    Reads a file written by save_bundle().
+    Sections are mapped, not read: each one is checked and decoded on first use,
+    and the arrays of the trie and the compact language model stay views over the mapping.
+    """
+    def __init__(self, filename, verify=True):
+        self.filename = filename
+        self.verify = verify
+        with open(filename, 'rb') as f:
+            # private pages, so in-place model updates do not write to the file
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, version, sections_cnt = BUNDLE_HEADER.unpack_from(self._mmap)
+        if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+            raise ValueError(filename + ": unsupported bundle file")
+        self.sections = {}
+        for i in range(sections_cnt):
+            name, offset, size, crc = BUNDLE_SECTION.unpack_from(self._mmap, BUNDLE_HEADER.size + i * BUNDLE_SECTION.size)
+            self.sections[name.rstrip(b'\0').decode('ascii')] = (offset, size, crc)
+        self._checked = set()
+        self._loaded = {}
+
+    def __contains__(self, name):
+        return name in self.sections
+
+    def section(self, name):
+        if name not in self.sections:
+            raise ValueError(self.filename + ": no section " + name)
+        offset, size, crc = self.sections[name]
+        data = memoryview(self._mmap)[offset:offset + size]
+        if self.verify and name not in self._checked:
+            if zlib.crc32(data) != crc:
+                raise ValueError(self.filename + ": section " + name + " is corrupted")
+            self._checked.add(name)
+        return data
+
+    def _array(self, name, typecode):
+        return np.frombuffer(self.section(name), dtype=typecode)
+
+    def language_model(self, compact=False):
+        """
+        compact=False rebuilds an updatable LanguageModel,
+        compact=True returns a CompactLanguageModel over the mapped arrays
+        """
+        key = 'compact_lm' if compact else 'lm'
+        if key not in self._loaded:
+            meta = json.loads(bytes(self.section('lm.meta')))
+            vocabulary = bytes(self.section('lm.vocabulary')).decode('utf-8')
+            words = vocabulary.split('\n') if vocabulary else []
+            arrays = [self._array(name, typecode) for name, typecode in LM_SECTIONS]
+            fingerprint = bytes.fromhex(meta['fingerprint'])
+            if compact:
+                unigram_counts, unigram_weights, bigram_offsets, bigram_successors, _, bigram_weights = arrays
+                lm = CompactLanguageModel.from_arrays(words, unigram_counts, unigram_weights, bigram_offsets,
+                                                      bigram_successors, bigram_weights, meta['alpha'],
+                                                      meta['unigram_def_value'], meta['all_entries'], fingerprint)
+            else:
+                lm = self._build_language_model(meta, words, *[a.tolist() for a in arrays])
+                lm._fingerprint = fingerprint
+            self._loaded[key] = lm
+        return self._loaded[key]
+
+    def _build_language_model(self, meta, words, unigram_counts, unigram_weights, bigram_offsets,
+                              bigram_successors, bigram_counts, bigram_weights):
+        lm = LanguageModel()
+        lm.alpha = meta['alpha']
+        lm.unigram_def_value = meta['unigram_def_value']
+        lm.all_entries = meta['all_entries']
+        lm.unigram_stat.update(zip(words, unigram_counts))
+        lm.unigram_weights = UnigramWeights(lm.unigram_def_value, zip(words, unigram_weights))
+        for word_id, word in enumerate(words):
+            lo, hi = bigram_offsets[word_id], bigram_offsets[word_id + 1]
+            if lo < hi:
+                successors = [words[i] for i in bigram_successors[lo:hi]]
+                lm.bigram_stat[word].update(zip(successors, bigram_counts[lo:hi]))
+                lm.bigram_weights[word].update(zip(successors, bigram_weights[lo:hi]))
+        return lm
+
+    def error_model(self):
+        if 'em' not in self._loaded:
+            data = json.loads(bytes(self.section('em')))
+            em = ErrorModel()
+            em.all_errors = data['all_errors']
+            for l1, l2, cnt in data['stat']:
+                em.stat[l1][l2] = cnt
+            em.weights = defaultdict(functools.partial(defaultdict, float))
+            for l1, l2, weight in data['weights']:
+                em.weights[l1][l2] = weight
+            self._loaded['em'] = em
+        return self._loaded['em']
+
+    def trie(self, error_model, language_model):
+        """
+        A CompactTrie querying the mapped section in place, the caller owns it
+        """
+        trie = CompactTrie.from_buffer(self.section('trie'), error_model, language_model,
+                                       name=self.filename + ": trie")
+        trie._mmap = self._mmap
+        return trie
+
+    def long_word_index(self, trie):
+        """
+        A SymmetricDeleteIndex searching the mapped arrays in place, the caller owns it
+        """
+        settings = json.loads(bytes(self.section('symspell.meta')))
+        if bytes.fromhex(settings['fingerprint']) != trie.language_model.fingerprint():
+            raise ValueError(self.filename + ": symspell index was built from another language model")
+        arrays = [self._array(name, typecode) for name, typecode in SYMSPELL_SECTIONS]
+        return SymmetricDeleteIndex.from_arrays(trie, settings, self.section('symspell.words'),
+                                                self.section('symspell.variants'), *arrays)
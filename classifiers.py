@@ -1,3 +1,4 @@
+import numpy as np
 import util
 
 def stat_clf(candidates, language_model):
@@ -5,6 +6,14 @@ def stat_clf(candidates, language_model):
     fix_error = sum([c.error_weight for c in candidates])
     return 1.7 * util.evaluate_words_nll(words, language_model, smoothing=False) + fix_error
 
+def stat_clf_batch(candidate_lists, language_model):
+    """
+    stat_clf of many candidate lists in one util.evaluate_words_nll_batch call
+    """
+    words_list = [[c.word.lower() for c in candidates] for candidates in candidate_lists]
+    fix_errors = np.array([sum([c.error_weight for c in candidates]) for candidates in candidate_lists], dtype=float)
+    return 1.7 * util.evaluate_words_nll_batch(words_list, language_model, smoothing=False) + fix_errors
+
 #def stat_clf(tokens, language_model):
 #    words = [t.fix_token.lower() for t in tokens if def_is_estimated_token(t)]
 #    fix_error = sum([t.fix_error for t in tokens if def_is_estimated_token(t)])
@@ -0,0 +1,305 @@
+from array import array
+from bisect import bisect_left
+import mmap
+import struct
+import zlib
+from trie import Trie
+
+TRIE_FILE_MAGIC = b'SPTRIE\0\0'
+TRIE_FILE_VERSION = 4
+# magic, version, char typecode, nodes, edges, words, alphabet bytes, body crc32, lm fingerprint
+TRIE_FILE_HEADER = struct.Struct('<8sI4sQQQQI32s')
+
+class CompactTrie(Trie):
+    """
+    Trie stored as sorted edge arrays instead of a graph of Node objects.
+    Nodes are numbered in BFS order, so the target of edge e is node e + 1
+    and the children of node n are the edges first_edge[n]..first_edge[n+1], sorted by letter.
+    child_order lists the same edges in the order the words were given to build(),
+    which is the order Trie visits the children of its nodes in.
+    Words added after build() go to a small node Trie searched along with the arrays.
+    """
+    def __init__(self, error_model, language_model):
+        super().__init__(error_model, language_model)
+        self._root = 0
+        self.first_edge = array('i', [0, 0])
+        self.edge_char = array('H')
+        self.child_order = array('i')
+        self.end = bytearray(1)
+        self.lm_weight = array('d', [0.0])
+        self.best_lm_weight = array('d', [float('inf')])
+        self.words_cnt = 0
+        self.added = None
+        self._mmap = None
+
+    def add(self, word):
+        path = self._path(word)
+        if path is not None:
+            if not self.end[path[-1]]:
+                self.end[path[-1]] = 1
+                self.lm_weight[path[-1]] = self._stored_weight(word)
+                self._refresh_best_lm_weight(path)
+                self.words_cnt += 1
+                self.version += 1
+            return
+        if self.added is None:
+            self.added = Trie(self.error_model, self.language_model)
+        if word not in self.added:
+            self.added.add(word)
+            self.words_cnt += 1
+            self.version += 1
+
+    def remove(self, word):
+        if self.hot_tier is not None:
+            self.hot_tier.remove(word)
+        if self.added is not None and self.added.remove(word):
+            self.words_cnt -= 1
+            self.version += 1
+            return True
+        path = self._path(word)
+        if path is None or not self.end[path[-1]]:
+            return False
+        self.end[path[-1]] = 0
+        self._refresh_best_lm_weight(path)
+        self.words_cnt -= 1
+        self.version += 1
+        return True
+
+    def update_weight(self, word):
+        if self.hot_tier is not None:
+            self.hot_tier.update_weight(word)
+        if self.added is not None and self.added.update_weight(word):
+            self.version += 1
+            return True
+        path = self._path(word)
+        if path is None or not self.end[path[-1]]:
+            return False
+        self.lm_weight[path[-1]] = self._stored_weight(word)
+        self._refresh_best_lm_weight(path)
+        self.version += 1
+        return True
+
+    def _refresh_best_lm_weight(self, path):
+        for node in reversed(path):
+            best = self.lm_weight[node] if self.end[node] else float('inf')
+            for child in range(self.first_edge[node] + 1, self.first_edge[node + 1] + 1):
+                best = min(best, self.best_lm_weight[child])
+            self.best_lm_weight[node] = best
+
+    def _find_candidates(self, prefix, max_candidates, limit_weight, expand):
+        candidates = super()._find_candidates(prefix, max_candidates, limit_weight, expand)
+        if self.added is None or len(self.added) == 0:
+            return candidates
+        exact = self.last_search_exact
+        self.added.astar = self.astar
+        self.added.bounded = self.bounded
+        for word, cand in self.added._find_candidates(prefix, max_candidates, limit_weight,
+                                                      self.added._expand).items():
+            if word not in candidates or cand.error_weight < candidates[word].error_weight:
+                candidates[word] = cand
+        # keep as many candidates as one search over all the words returns
+        kept_cnt = max_candidates if self.astar else max_candidates + 1
+        if len(candidates) > kept_cnt:
+            key = (lambda c: c.weight) if self.astar else (lambda c: c.error_weight)
+            candidates = {c.word: c for c in sorted(candidates.values(), key=key)[:kept_cnt]}
+        self.last_search_exact = exact and self.added.last_search_exact
+        return candidates
+
+    def _search_sorted(self, words, limit):
+        found = super()._search_sorted(words, limit)
+        if self.added is None or len(self.added) == 0:
+            return found
+        for word, added_found in self.added._search_sorted(words, limit).items():
+            words_found = found[word]
+            for added_word, weight in added_found.items():
+                if weight < words_found.get(added_word, float('inf')):
+                    words_found[added_word] = weight
+        return found
+
+    def __contains__(self, key):
+        return super().__contains__(key) or (self.added is not None and key in self.added)
+
+    def prefix_ends(self, text, start=0):
+        ends = super().prefix_ends(text, start)
+        if self.added is None or len(self.added) == 0:
+            return ends
+        return sorted(set(ends).union(self.added.prefix_ends(text, start)))
+
+    def build(self, words=None):
+        if words is None:
+            words = (w for w, cnt in self.language_model.unigram_stat.items() if cnt > 0)
+        words = list(words)
+        # rank of a word in the given order, the children of a node are ordered by their first word
+        order = sorted(range(len(words)), key=words.__getitem__)
+        ranks = [0] * len(words)
+        for rank, i in enumerate(order):
+            ranks[rank] = i
+        words = [words[i] for i in order]
+        self.alphabet = sorted(set(''.join(words)))
+        self.char_ids = {c: i for i, c in enumerate(self.alphabet)}
+        self._cost_table = None
+        char_typecode = 'H' if len(self.alphabet) <= 0xFFFF else 'I'
+
+        first_edge = array('i')
+        edge_char = array(char_typecode)
+        child_order = array('i')
+        end = bytearray()
+        lm_weight = array('d')
+        unigram_weights = self.language_model.unigram_weights
+        shift = self.language_model.unigram_weight_shift()
+
+        # every node is a range of sorted words sharing a prefix of length depth
+        level = [(0, len(words))]
+        depth = 0
+        while level:
+            next_level = []
+            for lo, hi in level:
+                first_edge.append(len(edge_char))
+                if lo < hi and len(words[lo]) == depth:
+                    end.append(1)
+                    lm_weight.append(unigram_weights[words[lo]] - shift)
+                    lo += 1
+                else:
+                    end.append(0)
+                    lm_weight.append(0.0)
+                children = []
+                while lo < hi:
+                    letter = words[lo][depth]
+                    group_hi = lo + 1
+                    while group_hi < hi and words[group_hi][depth] == letter:
+                        group_hi += 1
+                    children.append((min(ranks[lo:group_hi]), len(edge_char)))
+                    edge_char.append(self.char_ids[letter])
+                    next_level.append((lo, group_hi))
+                    lo = group_hi
+                child_order.extend(edge for _, edge in sorted(children))
+            level = next_level
+            depth += 1
+        first_edge.append(len(edge_char))
+
+        # children have greater ids than their parent, so one backward pass fills the subtree minimums
+        best_lm_weight = array('d', [float('inf')]) * len(end)
+        for node in range(len(end) - 1, -1, -1):
+            best = lm_weight[node] if end[node] else float('inf')
+            for child in range(first_edge[node] + 1, first_edge[node + 1] + 1):
+                if best_lm_weight[child] < best:
+                    best = best_lm_weight[child]
+            best_lm_weight[node] = best
+
+        self.first_edge = first_edge
+        self.edge_char = edge_char
+        self.child_order = child_order
+        self.end = end
+        self.lm_weight = lm_weight
+        self.best_lm_weight = best_lm_weight
+        self.words_cnt = len(words)
+        self.version += 1
+
+    def _edges(self, node):
+        lo, hi = self.first_edge[node], self.first_edge[node + 1]
+        edges = self.child_order[lo:hi]
+        return zip(map(self.edge_char.__getitem__, edges), map((1).__add__, edges))
+
+    def _child(self, node, letter):
+        char_id = self.char_ids.get(letter)
+        if char_id is None:
+            return None
+        return self._child_by_id(node, char_id)
+
+    def _child_by_id(self, node, char_id):
+        lo, hi = self.first_edge[node], self.first_edge[node + 1]
+        edge = bisect_left(self.edge_char, char_id, lo, hi)
+        if edge < hi and self.edge_char[edge] == char_id:
+            return edge + 1
+        return None
+
+    def _child_rank(self, node, char_id):
+        lo, hi = self.first_edge[node], self.first_edge[node + 1]
+        return list(self.child_order[lo:hi]).index(self._child_by_id(node, char_id) - 1)
+
+    def _is_end(self, node):
+        return self.end[node] == 1
+
+    def _lm_weight(self, node):
+        return self.lm_weight[node] + self.weight_shift
+
+    def _best_lm_weight(self, node):
+        return self.best_lm_weight[node] + self.weight_shift
+
+    def __len__(self):
+        return self.words_cnt
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.to_bytes())
+
+    def to_bytes(self):
+        alphabet = ''.join(self.alphabet).encode('utf-8')
+        # the file has the weights with the shift, as the language model of the loading process returns them
+        shift = self.language_model.unigram_weight_shift()
+        lm_weight, best_lm_weight = self.lm_weight, self.best_lm_weight
+        if shift != 0.0:
+            lm_weight = array('d', (w + shift for w in lm_weight))
+            best_lm_weight = array('d', (w + shift for w in best_lm_weight))
+        # 8-byte aligned sections, widest items first
+        sections = [bytes(lm_weight), bytes(best_lm_weight), bytes(self.first_edge), bytes(self.child_order),
+                    bytes(self.edge_char), bytes(self.end), alphabet]
+        body = b''.join(section + b'\0' * (-len(section) % 8) for section in sections)
+        header = TRIE_FILE_HEADER.pack(TRIE_FILE_MAGIC, TRIE_FILE_VERSION,
+                                       self.edge_char.typecode.encode('ascii'),
+                                       len(self.end), len(self.edge_char), self.words_cnt,
+                                       len(alphabet), zlib.crc32(body),
+                                       self.language_model.fingerprint())
+        return header + b'\0' * (-len(header) % 8) + body
+
+    @classmethod
+    def load(cls, filename, error_model, language_model, verify=False):
+        """
+        Maps a file written by save() and queries it in place.
+        The arrays are memoryviews over the mapping, no per-node objects are created.
+        """
+        with open(filename, 'rb') as f:
+            # private pages, so weight updates and removals do not write to the file
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        trie = cls.from_buffer(mm, error_model, language_model, verify, filename)
+        trie._mmap = mm
+        return trie
+
+    @classmethod
+    def from_buffer(cls, buffer, error_model, language_model, verify=False, name='trie'):
+        """
+        Queries the bytes of to_bytes() in place, buffer must stay alive and 8-byte aligned
+        """
+        trie = cls(error_model, language_model)
+        magic, version, char_typecode, nodes_cnt, edges_cnt, words_cnt, alphabet_len, crc, fingerprint = \
+            TRIE_FILE_HEADER.unpack_from(buffer)
+        if magic != TRIE_FILE_MAGIC or version != TRIE_FILE_VERSION:
+            raise ValueError(name + ": unsupported trie file")
+        if fingerprint != language_model.fingerprint():
+            raise ValueError(name + ": trie was built from another language model")
+        offset = TRIE_FILE_HEADER.size + (-TRIE_FILE_HEADER.size % 8)
+        view = memoryview(buffer)
+        if verify and zlib.crc32(view[offset:]) != crc:
+            raise ValueError(name + ": trie file is corrupted")
+
+        def section(typecode, cnt):
+            nonlocal offset
+            size = struct.calcsize(typecode) * cnt
+            data = view[offset:offset + size]
+            offset += size + (-size % 8)
+            return data.cast(typecode)
+
+        trie.lm_weight = section('d', nodes_cnt)
+        trie.best_lm_weight = section('d', nodes_cnt)
+        shift = language_model.unigram_weight_shift()
+        if shift != 0.0:
+            trie.lm_weight = array('d', (w - shift for w in trie.lm_weight))
+            trie.best_lm_weight = array('d', (w - shift for w in trie.best_lm_weight))
+        trie.first_edge = section('i', nodes_cnt + 1)
+        trie.child_order = section('i', edges_cnt)
+        trie.edge_char = section(char_typecode.rstrip(b'\0').decode('ascii'), edges_cnt)
+        trie.end = section('B', nodes_cnt)
+        trie.alphabet = list(bytes(view[offset:offset + alphabet_len]).decode('utf-8'))
+        trie.char_ids = {c: i for i, c in enumerate(trie.alphabet)}
+        trie.words_cnt = words_cnt
+        return trie
@@ -4,6 +4,59 @@ import functools
 import numpy as np
 import operator
 
+class ErrorCostTable:
+    """
+    Dense error weights indexed by char ids.
+    Rows are prefix letters: the trie alphabet ids, then letters known only to the error model,
+    then the empty prefix and any unknown letter. Columns are the trie alphabet ids.
+    Missing errors cost inf, so they never pass a weight limit.
+    """
+    def __init__(self, error_model, alphabet, similar_symbols, allowed_letters, transposition_weight):
+        weights = error_model.weights
+        insertions = weights.get('', {})
+        extra_letters = sorted(l for l in weights if l != '' and l not in alphabet)
+        self.prefix_ids = {l: i for i, l in enumerate(list(alphabet) + extra_letters)}
+        self.empty_id = len(self.prefix_ids)
+        self.unknown_id = self.empty_id + 1
+        prefix_letters = list(alphabet) + extra_letters + ['', None]
+
+        self.substitution = np.full((len(prefix_letters), len(alphabet)), np.inf)
+        self.insertion = np.full(len(alphabet), np.inf)
+        self.deletion = np.full(len(prefix_letters), np.inf)
+        for t, trie_letter in enumerate(alphabet):
+            if trie_letter in insertions:
+                self.insertion[t] = insertions[trie_letter]
+        for p, prefix_letter in enumerate(prefix_letters):
+            row = weights.get(prefix_letter, {}) if prefix_letter is not None else {}
+            if '' in row:
+                self.deletion[p] = row['']
+            for t, trie_letter in enumerate(alphabet):
+                if trie_letter in row:
+                    if prefix_letter and similar_symbols.get(trie_letter) == ord(prefix_letter):
+                        self.substitution[p, t] = 0.5
+                    else:
+                        self.substitution[p, t] = row[trie_letter]
+        self.allowed = np.array([l in allowed_letters for l in alphabet], dtype=bool)
+        self.transposition = transposition_weight
+
+        # cheapest error transition into an allowed child of each prefix letter
+        # (substitution, insertion, or duplication when the child is the prefix letter itself)
+        costs = np.minimum(self.substitution, self.insertion)
+        costs[np.arange(len(alphabet)), np.arange(len(alphabet))] = self.insertion
+        self.min_cost = np.min(costs, axis=1, where=self.allowed, initial=np.inf).tolist()
+        self.min_insertion = float(self.insertion[self.allowed].min()) if self.allowed.any() else float('inf')
+
+        # python lists for the search loop, indexing numpy arrays per element is slow
+        self.substitution_rows = self.substitution.tolist()
+        self.insertion_row = self.insertion.tolist()
+        self.deletion_row = self.deletion.tolist()
+        self.allowed_row = self.allowed.tolist()
+
+    def prefix_id(self, prefix, i=0):
+        if len(prefix) <= i:
+            return self.empty_id
+        return self.prefix_ids.get(prefix[i], self.unknown_id)
+
 class ErrorModel:
     def __init__(self):
         # transposition
@@ -51,6 +104,40 @@ class ErrorModel:
                 self.weights[l1][l2] = -np.log(l2_cnt / self.all_errors)
                 #self.weights[l1][l2] = -np.log(l2_cnt / l1_overall)
 
+    def pruned(self, min_count):
+        """
+        Returns a new model without the errors seen fewer than min_count times,
+        the weights of the others do not change
+        """
+        em = ErrorModel()
+        em.all_errors = self.all_errors
+        for l1, dict_values in self.stat.items():
+            for l2, l2_cnt in dict_values.items():
+                if l2_cnt >= min_count:
+                    em.stat[l1][l2] = l2_cnt
+        em.calc_weights()
+        return em
+
+    def quantized(self, bits=8):
+        """
+        Returns a copy whose weights are rounded to 2**bits levels, see util.QuantizedArray.
+        The rounded weights stay floats in the weights dicts, so this saves no memory and only simulates
+        the accuracy of quantized error weights: the model has at most one weight per pair of letters
+        and the search reads them from the dense ErrorCostTable.
+        """
+        em = ErrorModel()
+        em.all_errors = self.all_errors
+        em.stat = self.stat
+        keys = [(l1, l2) for l1, dict_values in self.weights.items() for l2 in dict_values]
+        weights = util.QuantizedArray([self.weights[l1][l2] for l1, l2 in keys], bits)
+        em.weights = defaultdict(functools.partial(defaultdict, float))
+        for (l1, l2), weight in zip(keys, weights.tolist()):
+            em.weights[l1][l2] = weight
+        return em
+
+    def cost_table(self, alphabet, similar_symbols, allowed_letters, transposition_weight=4.0):
+        return ErrorCostTable(self, alphabet, similar_symbols, allowed_letters, transposition_weight)
+
     def build_from_file(self, filename):
         orig_requests = []
         fix_requests = []
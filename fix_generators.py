@@ -1,5 +1,3 @@
-from dataclasses import dataclass, field
-from typing import Any
 import operator
 import numpy as np
 import util
@@ -9,6 +7,7 @@ import copy
 from collections import defaultdict
 from trie import Candidate
 import itertools
+from heapq import nsmallest
 from classifiers import stat_clf
 
 re_preprocess_req1 = r"((?:\s+)|(\S+))"
@@ -19,26 +18,111 @@ re_url = r"^(https?:\/\/)(?:[-\w]+\.)?([-\w]+)\.\w+(?:\.\w+)?\/?.*$"
 re_digit = r"^(\d+)$"
 re_j1 = r'^(?:(\w) (\d\d site:\.\w{2,4}))$'
 
-@dataclass(order=True)
-class CandidateList:
-    def __init__(self, candidates, language_model):
-        self.candidates = candidates
-        self.weight = stat_clf(candidates, language_model)
+pattern_preprocess_req1 = re.compile(r"(\s+)|(\S+)")
+pattern_preprocess_req2 = re.compile(re_preprocess_req2)
+pattern_email = re.compile(re_email)
+pattern_url = re.compile(re_url)
+stop_words = frozenset(nltk_util.stop_words_en + nltk_util.stop_words_ru)
+# tokens of recent requests, shared by preprocess_req calls
+preprocess_memo = util.LRUCache(100_000)
 
-    def add(self, cand, language_model):
-        self.candidates.append(cand)
-        self.weight = stat_clf(self.candidates, language_model)
+class Hypothesis:
+    """
+    Immutable beam search state: the last candidate and the hypothesis it extends, so extensions share prefixes.
+    nll and error are the sums of stat_clf, extended by one transition_nll term and one error weight.
+    """
+    __slots__ = ('candidate', 'prev', 'nll', 'error', 'weight')
+
+    def __init__(self, candidate, prev, nll, error):
+        self.candidate = candidate
+        self.prev = prev
+        self.nll = nll
+        self.error = error
+        self.weight = 1.7 * nll + error
+
+    @classmethod
+    def start(cls, candidate, language_model):
+        nll = util.transition_nll(None, candidate.word.lower(), language_model, smoothing=False)
+        return cls(candidate, None, nll, 0 + candidate.error_weight)
+
+    def extend(self, candidate, language_model):
+        nll = self.nll + util.transition_nll(self.candidate.word.lower(), candidate.word.lower(), language_model,
+                                             smoothing=False)
+        return Hypothesis(candidate, self, nll, self.error + candidate.error_weight)
+
+    @property
+    def candidates(self):
+        candidates = []
+        hyp = self
+        while hyp is not None:
+            candidates.append(hyp.candidate)
+            hyp = hyp.prev
+        candidates.reverse()
+        return candidates
+
+def beam_search(lattice, language_model, first_width=5, next_width=10, beam_width=3):
+    """
+    Best candidate sequences of a lattice, a list of candidate lists sorted by weight, one per word.
+    Keeps beam_width hypotheses after each word, trying first_width candidates of the first word
+    and next_width candidates of the next ones.
+    """
+    beam = [Hypothesis.start(c, language_model) for c in lattice[0][:first_width]]
+    for candidates in lattice[1:]:
+        candidates = candidates[:next_width]
+        # stable, as sorted()[:beam_width]
+        beam = nsmallest(beam_width, (hyp.extend(c, language_model) for hyp in beam for c in candidates),
+                         key=operator.attrgetter('weight'))
+    return beam
+
+def viterbi_search(lattice, language_model, width=10, n_best=3):
+    """
+    Exact n_best candidate sequences of a lattice under the bigram model of stat_clf (list Viterbi),
+    trying width candidates of each word. The transitions between adjacent candidate sets
+    are util.transition_nll_matrix matrices, so a query of n words costs O(n * width^2 * n_best).
+    """
+    columns = [candidates[:width] for candidates in lattice]
+    words = [[c.word.lower() for c in candidates] for candidates in columns]
+    # scores[i, r] is the weight of the r-th best path ending in candidate i of the column
+    errors = np.array([c.error_weight for c in columns[0]], dtype=float)
+    scores = (1.7 * util.transition_nll_matrix(None, words[0], language_model, smoothing=False) + errors)[:, None]
+    ranks_l = [1]
+    back = []
+    for j in range(1, len(columns)):
+        errors = np.array([c.error_weight for c in columns[j]], dtype=float)
+        transition = 1.7 * util.transition_nll_matrix(words[j - 1], words[j], language_model, smoothing=False)
+        # rows are (previous candidate, rank) pairs, columns are the candidates of the column
+        total = (scores[:, :, None] + transition[:, None, :] + errors).reshape(-1, len(columns[j]))
+        best = np.argsort(total, axis=0, kind='stable')[:n_best]
+        scores = np.take_along_axis(total, best, axis=0).T
+        back.append(best.T)
+        ranks_l.append(scores.shape[1])
 
-    candidates: Any=field(compare=False)
-    weight : float
+    res = []
+    for flat_idx in np.argsort(scores.ravel(), kind='stable')[:n_best]:
+        i, r = divmod(int(flat_idx), ranks_l[-1])
+        path = [i]
+        for j in range(len(columns) - 1, 0, -1):
+            i, r = divmod(int(back[j - 1][i, r]), ranks_l[j - 1])
+            path.append(i)
+        path.reverse()
+        hyp = Hypothesis.start(columns[0][path[0]], language_model)
+        for j in range(1, len(columns)):
+            hyp = hyp.extend(columns[j][path[j]], language_model)
+        res.append(hyp)
+    # exact weights of stat_clf, the matrix sums may round differently
+    return sorted(res, key=operator.attrgetter('weight'))
 
 class Token:
+    __slots__ = ('token', 'need_correct', 'is_delim', 'is_spec', 'is_digit', 'fix_token', 'fix_error',
+                 'is_first_upper', 'is_all_upper', 'fix_words', 'is_stop_word', 'is_one_symbol', 'is_spec_word')
+
     def __init__(self, token, need_correct, is_delim=False, is_stop_word=False, is_one_symbol=False):
         self.token = token
         self.need_correct = need_correct
         self.is_delim = is_delim
         self.is_spec = False
         self.is_digit = False
+        self.is_spec_word = False
         self.fix_token = self.token
         self.fix_error = 0
         if self.need_correct:
@@ -52,6 +136,23 @@ class Token:
         self.is_stop_word = is_stop_word
         self.is_one_symbol = is_one_symbol
 
+    def copy(self):
+        token = Token.__new__(Token)
+        token.token = self.token
+        token.need_correct = self.need_correct
+        token.is_delim = self.is_delim
+        token.is_spec = self.is_spec
+        token.is_digit = self.is_digit
+        token.fix_token = self.fix_token
+        token.fix_error = self.fix_error
+        token.is_first_upper = self.is_first_upper
+        token.is_all_upper = self.is_all_upper
+        token.fix_words = list(self.fix_words)
+        token.is_stop_word = self.is_stop_word
+        token.is_one_symbol = self.is_one_symbol
+        token.is_spec_word = self.is_spec_word
+        return token
+
     def __repr__(self):
         rep = 'Token(' + self.token + ', ' + str(self.is_delim) + ', ' \
             + str(self.need_correct) + ', is_first_upper=' + str(self.is_first_upper) \
@@ -68,11 +169,13 @@ def def_is_estimated_token(token):
     #    or token.is_digit
 
 def def_is_spec_token(token):
-    res = (re.search(re_email, token) or re.search(re_url, token))
+    # the patterns need '@' and '://', most tokens are rejected without a search
+    res = ('@' in token and pattern_email.search(token)) or ('://' in token and pattern_url.search(token))
     return res
 
 def def_is_digit_token(token):
-    return re.search(re_digit, token)
+    # the same as re_digit, \d matches the decimal characters
+    return token.isdecimal()
 
 def def_is_spec_join_token(req):
     res = re.findall(re_j1, req)
@@ -83,51 +186,65 @@ def def_is_spec_join_token(req):
         return ''
 
 def def_is_stop_word(token):
-    res = token in (nltk_util.stop_words_en + nltk_util.stop_words_ru)
-    return res
+    return token in stop_words
 
 def preprocess_req(req, second_stage=True):
-    l1 = []
-    for t in re.findall(re_preprocess_req1, req):
-        l1.append(Token(t[0], t[1] != '', t[1] == ''))
-    if not second_stage: return l1
-    l2= []
-    for t in l1:
-        if t.is_delim:
-            l2.append(t)
+    """
+    Splits a request into tokens, the tokens of recent requests are memoized.
+    The tokens are shared between calls, copy() a token before changing it.
+    """
+    key = (req, second_stage)
+    tokens = preprocess_memo.get(key)
+    if tokens is None:
+        tokens = tokenize_req(req, second_stage)
+        preprocess_memo.put(key, tokens)
+    return list(tokens)
+
+def tokenize_req(req, second_stage=True):
+    tokens = []
+    for m in pattern_preprocess_req1.finditer(req):
+        chunk = m.group()
+        if m.lastindex == 1:
+            tokens.append(Token(chunk, False, True))
+            continue
+        t = Token(chunk, True)
+        if not second_stage:
+            tokens.append(t)
             continue
         # second check
-        if def_is_spec_token(t.token):
+        if def_is_spec_token(chunk):
             t.is_stop_word = False
             t.need_correct = False
             t.is_spec = True
-            l2.append(t)
+            tokens.append(t)
             continue
-        if def_is_digit_token(t.token):
+        if def_is_digit_token(chunk):
             t.need_correct = False
             t.is_digit = True
-            l2.append(t)
+            tokens.append(t)
             continue
-        if def_is_stop_word(t.token):
+        if chunk in stop_words:
             t.is_stop_word = True
             t.need_correct = False
-            l2.append(t)
+            tokens.append(t)
             continue
 
-        for t2 in re.findall(re_preprocess_req2, t.token):
-            is_delim = (t2[1] == '')
-            is_stop_word = not is_delim and def_is_stop_word(t2[0])
-            is_spec_word = not is_delim and def_is_spec_token(t2[0])
-            is_digit_word = not is_delim and def_is_digit_token(t2[0])
-            is_one_symbol = (len(t2[0]) == 1) and not is_spec_word \
+        for m2 in pattern_preprocess_req2.finditer(chunk):
+            word = m2.group()
+            is_delim = m2.group(2) is None
+            is_stop_word = not is_delim and word in stop_words
+            # \w+ has no '@' or ':', so words are never emails or urls
+            is_spec_word = False
+            is_digit_word = not is_delim and word.isdecimal()
+            is_one_symbol = (len(word) == 1) and not is_spec_word \
                 and not is_delim and not is_digit_word
             need_correct =  not is_delim and not is_stop_word \
                 and not is_spec_word and not is_one_symbol and not is_digit_word
-            new_token = Token(t2[0], need_correct, is_delim, is_stop_word, is_one_symbol)
+            new_token = Token(word, need_correct, is_delim, is_stop_word, is_one_symbol)
             new_token.is_digit = is_digit_word
             new_token.is_spec_word = is_spec_word
-            l2.append(new_token)
-    return l2
+            tokens.append(new_token)
+    return tokens
 
 def reconstruct_req(tokens, fix_dict=None):
     req = ''
@@ -150,16 +267,23 @@ def reconstruct_req(tokens, fix_dict=None):
                 req += fix_word
     return req
 
-def word_generator(tokens, language_model, trie, max_candidates=5):
+def word_generator(tokens, language_model, trie, max_candidates=5, long_word_index=None, long_word_len=8,
+                   first_width=5, next_width=10, beam_width=3, decoder='beam'):
     """
     Fixing typos in query words
+    Words of long_word_len letters and longer are looked up in long_word_index if it is given
+    The candidate sequences are combined by beam_search with the given widths,
+    or with decoder='viterbi' by viterbi_search of next_width candidates per word and beam_width results
     """
     fix_words_l = []
     tokens_fix_indices = []
     for i, token in enumerate(tokens):
         orig_word = token.token.lower()
         if token.need_correct:
-            candidates = trie.find_candidates(orig_word, max_candidates)
+            if long_word_index is not None and len(orig_word) >= long_word_len:
+                candidates = long_word_index.find_candidates(orig_word, max_candidates)
+            else:
+                candidates = trie.find_candidates(orig_word, max_candidates)
             fix_words = sorted([c for c in candidates.values() if language_model.unigram_stat[c.word] > 0])
             fix_words = fix_words if len(fix_words) > 0 else [Candidate(orig_word, 
                                                                         language_model.unigram_weights[orig_word],
@@ -179,22 +303,15 @@ def word_generator(tokens, language_model, trie, max_candidates=5):
         res.append((fix_req_text, fix_list))
         return res
 
-    # top 5
-    res_cl = []
-    res_cl.extend([CandidateList([c], language_model) for c in fix_words_l[0][:5]])
-    for i, next_list in enumerate(fix_words_l[1:]):
-        next_list = next_list[:10]
-        res_cl_new = []
-        for cl in res_cl:
-            for curr_cand in next_list:
-                cl_new = copy.deepcopy(cl)
-                cl_new.add(curr_cand, language_model)
-                res_cl_new.append(cl_new)
-        res_cl = sorted(res_cl_new)[:3]
-    for cl in res_cl:
-        fix_dict = {token_idx: cl.candidates[cand_idx].word
+    if decoder == 'viterbi':
+        hyps = viterbi_search(fix_words_l, language_model, next_width, beam_width)
+    else:
+        hyps = beam_search(fix_words_l, language_model, first_width, next_width, beam_width)
+    for hyp in hyps:
+        candidates = hyp.candidates
+        fix_dict = {token_idx: candidates[cand_idx].word
                     for cand_idx, token_idx in enumerate(tokens_fix_indices) if tokens[token_idx].need_correct}
-        res.append((reconstruct_req(tokens, fix_dict), cl.candidates))
+        res.append((reconstruct_req(tokens, fix_dict), candidates))
     
     return res
 
@@ -217,29 +334,71 @@ def def_can_join(token):
     #return token.need_correct or token.is_one_symbol or token.is_stop_word
     return not token.is_delim
 
-def join_generator(request, tokens, language_model):
-    indices = [i for i, t in enumerate(tokens) if t.is_delim]
-    fix_request = request
+def join_generator(request, tokens, language_model, max_join=4):
+    """
+    Joins runs of up to max_join words separated by single delimiters into vocabulary words,
+    choosing the joins with the least evaluate_words_nll of the request.
+    Dynamic programming over the words: the states are the joined words ending at each word
+    and only the bigram of the previous word is scored, so the cost is linear in the number of words.
+    """
+    positions = [i for i, t in enumerate(tokens) if def_is_estimated_token(t)]
     fix_tokens = tokens
-    fix_cl = [Candidate(t.token, 0, 0) for t in fix_tokens if def_is_estimated_token(t)]
-    if len(fix_cl) == 0: return (fix_request, fix_cl)
+    fix_cl = [Candidate(tokens[i].token, 0, 0) for i in positions]
+    if len(fix_cl) == 0: return (request, fix_cl)
 
-    fix_request_l = stat_clf(fix_cl, language_model)
-    join_cnt = 0 # number of join made
-    for idx in indices:
-        can_join = def_can_join(fix_tokens[idx-1-join_cnt]) \
-            and (idx+1-join_cnt) <= (len(fix_tokens) - 1) \
-            and def_can_join(fix_tokens[idx+1-join_cnt])
-        if can_join:
-            joined_token = Token(fix_tokens[idx-1-join_cnt].token + fix_tokens[idx+1-join_cnt].token, True)
-            candidate_tokens = fix_tokens[:idx-1-join_cnt] + [joined_token] + fix_tokens[idx - join_cnt + 2:]
-            candidate_cl = [Candidate(t.token, 0, 0) for t in candidate_tokens if def_is_estimated_token(t)]
-            candidate_l = stat_clf(candidate_cl, language_model)
-            if  candidate_l < fix_request_l:
-                fix_tokens = candidate_tokens
-                fix_request_l = candidate_l
-                fix_cl = candidate_cl
-                join_cnt += 2
+    words = [tokens[i].token.lower() for i in positions]
+    # joinable[k]: words k and k + 1 are separated by one delimiter
+    joinable = [q - p == 2 and def_can_join(tokens[p]) and def_can_join(tokens[q])
+                for p, q in zip(positions, positions[1:])]
+
+    # starts[end]: starts of the words[start:end] which may be one word, the word itself comes first
+    starts = [[]]
+    for end in range(1, len(words) + 1):
+        starts.append([end - 1])
+        for start in range(end - 2, max(end - max_join, 0) - 1, -1):
+            if not joinable[start]:
+                break
+            if language_model.unigram_stat.get(''.join(words[start:end]), 0) > 0:
+                starts[end].append(start)
+    if all(len(s) == 1 for s in starts[1:]):
+        return (reconstruct_req(fix_tokens), fix_cl)
+
+    # best[end][start]: (nll, start of the previous word) of the best joining of words[:end] ending with words[start:end]
+    best = [{} for _ in range(len(words) + 1)]
+    for end in range(1, len(words) + 1):
+        for start in starts[end]:
+            word = ''.join(words[start:end])
+            if start == 0:
+                best[end][start] = (util.transition_nll(None, word, language_model, smoothing=False), None)
+                continue
+            best[end][start] = min((nll + util.transition_nll(''.join(words[prev_start:start]), word,
+                                                                language_model, smoothing=False), prev_start)
+                                   for prev_start, (nll, _) in best[start].items())
+
+    spans = []
+    end = len(words)
+    start = min(best[end], key=lambda s: best[end][s][0])
+    while start is not None:
+        spans.append((start, end))
+        start, end = best[end][start][1], start
+    spans.reverse()
+    if len(spans) == len(words):
+        return (reconstruct_req(fix_tokens), fix_cl)
+
+    candidate_tokens = []
+    next_token = 0
+    for start, end in spans:
+        candidate_tokens.extend(tokens[next_token:positions[start]])
+        if end - start == 1:
+            candidate_tokens.append(tokens[positions[start]])
+        else:
+            candidate_tokens.append(Token(''.join(tokens[positions[k]].token for k in range(start, end)), True))
+        next_token = positions[end - 1] + 1
+    candidate_tokens.extend(tokens[next_token:])
+    candidate_cl = [Candidate(t.token, 0, 0) for t in candidate_tokens if def_is_estimated_token(t)]
+    if stat_clf(candidate_cl, language_model) < stat_clf(fix_cl, language_model):
+        fix_tokens = candidate_tokens
+        fix_cl = candidate_cl
     return (reconstruct_req(fix_tokens), fix_cl)
 
 def join_generator_simple(request, language_model):
@@ -259,14 +418,14 @@ def join_generator_simple(request, language_model):
 def def_can_split(token):
     return token.need_correct
 
-def split_generator_complex(req, language_model):
+def split_generator_complex(req, language_model, trie=None):
     tokens = preprocess_req(req, second_stage=True)
     new_tokens = []
     new_fix_cl = []
     is_split =False
     for i, token in enumerate(tokens):
         if not token.is_delim and not token.is_digit:
-            fix_tokens, fix_cl, is_token_split = split_generator(token, language_model)
+            fix_tokens, fix_cl, is_token_split = split_generator(token, language_model, trie)
             if is_token_split:
                 is_split = True
                 new_tokens.extend(fix_tokens)
@@ -281,25 +440,67 @@ def split_generator_complex(req, language_model):
     else:
         return False
 
-def split_generator(token, language_model):
-    is_split = False
+def segment_text(text, language_model, trie=None, max_word_len=30):
+    """
+    Splits text into vocabulary words with the least evaluate_words_nll, returns the (start, end) spans of the words
+    in text or None when text is not a sequence of words.
+    Word-break dynamic programming: the states are the words ending at each position, the trie gives the words
+    starting at a position in one walk. L * W states for the longest word W, each reached from at most W states
+    with one transition_nll_matrix per position. Without a trie the words are looked up up to max_word_len.
+    """
+    # lowercased per character so that the spans index text, a character whose lowercase is longer
+    # (such as 'İ') is kept as is and never matches a word
+    text = ''.join(c if len(c.lower()) != 1 else c.lower() for c in text)
+    # best[end][start]: (nll, start of the previous word) of the best sequence ending with the word text[start:end]
+    best = [{} for _ in range(len(text) + 1)]
+    for start in range(len(text)):
+        if start > 0 and not best[start]:
+            continue
+        if trie is not None:
+            ends = trie.prefix_ends(text, start)
+        else:
+            ends = [end for end in range(start + 1, min(len(text), start + max_word_len) + 1)
+                    if language_model.unigram_stat.get(text[start:end], 0) > 0]
+        if not ends:
+            continue
+        words = [text[start:end] for end in ends]
+        if start == 0:
+            for end, nll in zip(ends, util.transition_nll_matrix(None, words, language_model, smoothing=False)):
+                best[end][start] = (nll, None)
+            continue
+        prev_starts = list(best[start])
+        prev_words = [text[prev_start:start] for prev_start in prev_starts]
+        matrix = util.transition_nll_matrix(prev_words, words, language_model, smoothing=False)
+        matrix += np.array([best[start][prev_start][0] for prev_start in prev_starts])[:, None]
+        for j, end in enumerate(ends):
+            i = int(np.argmin(matrix[:, j]))
+            best[end][start] = (matrix[i, j], prev_starts[i])
+
+    if not best[len(text)]:
+        return None
+    start = min(best[len(text)], key=lambda s: best[len(text)][s][0])
+    spans = []
+    end = len(text)
+    while start is not None:
+        spans.append((start, end))
+        start, end = best[end][start][1], start
+    return spans[::-1]
+
+def split_generator(token, language_model, trie=None):
+    """
+    Splits the token into the best sequence of any number of words found by segment_text,
+    when it is scored better than the token itself.
+    """
     text_to_split = token.token
-    indices = np.array([i for i, _ in enumerate(text_to_split[1:]) if text_to_split[i] != ' ']) + 1
     fix_tokens = [token]
     fix_cl = [Candidate(text_to_split, 0, 0)]
-    fix_request_l = stat_clf(fix_cl, language_model)
-    for idx in indices:
-        candidate = text_to_split[:idx] + ' ' + text_to_split[idx:]
-        candidate_tokens = preprocess_req(candidate)
-        candidate_cl = [Candidate(t.token, 0, 0) for t in candidate_tokens if not t.is_delim]
-        #error_weight = sum([(-2) * int(t.is_spec) for t in candidate_tokens])
-        candidate_l = stat_clf(candidate_cl, language_model)
-        #candidate_l += error_weight
-        if candidate_l < fix_request_l:
-            is_split = True
-            fix_tokens = candidate_tokens
-            fix_cl = candidate_cl
-    if is_split:
-        for t in fix_tokens:
-            t.need_correct = not t.is_delim
-    return (fix_tokens, fix_cl, is_split)
+    spans = segment_text(text_to_split, language_model, trie)
+    if spans is None or len(spans) < 2:
+        return (fix_tokens, fix_cl, False)
+    candidate_cl = [Candidate(text_to_split[start:end], 0, 0) for start, end in spans]
+    if stat_clf(candidate_cl, language_model) >= stat_clf(fix_cl, language_model):
+        return (fix_tokens, fix_cl, False)
+    fix_tokens = [t.copy() for t in preprocess_req(' '.join(c.word for c in candidate_cl))]
+    for t in fix_tokens:
+        t.need_correct = not t.is_delim
+    return (fix_tokens, candidate_cl, True)
@@ -7,18 +7,31 @@ from collections import Counter, defaultdict
 import functools
 import util
 from trie import Trie
+from compact_trie import CompactTrie
+from bundle import save_bundle
+from symspell import SymmetricDeleteIndex
 import sys
+import os
 from fix_generators import preprocess_req
 import nltk_util
 from collections import defaultdict
 
 def build_and_save_language_model(lm):
-    lm.build_from_file("queries_all.txt")
+    lm.build_from_file("queries_all.txt", workers=os.cpu_count() or 1)
+    # cache the fingerprint in the pickle, so startup does not rehash the vocabulary
+    lm.fingerprint()
     util.save_obj(lm, 'lm')
 
 def build_and_save_error_model(em):
     em.build_from_file("queries_all.txt")
     util.save_obj(em, 'em')
+
+def build_and_save_bundle(lm, em):
+    trie = CompactTrie(em, lm)
+    trie.build()
+    long_word_index = SymmetricDeleteIndex(trie)
+    long_word_index.build()
+    save_bundle('model.bundle', lm, em, trie, long_word_index)
     
 if __name__ == '__main__':
     try:
@@ -30,6 +43,17 @@ if __name__ == '__main__':
         lm = LanguageModel()
         build_and_save_language_model(lm)
 
+        print("Start ErrorModel loading", file=sys.stderr)
+        try:
+            em = util.load_obj('em')
+        except OSError:
+            print("Start ErrorModel building", file=sys.stderr)
+            em = ErrorModel()
+            build_and_save_error_model(em)
+
+        print("Start Trie building and bundle saving", file=sys.stderr)
+        build_and_save_bundle(lm, em)
+
     except RuntimeError as err:
         print(err, file=sys.stderr)
     except:
@@ -1,7 +1,107 @@
+from array import array
 from collections import Counter, defaultdict
 import functools
+import hashlib
+import heapq
+import itertools
+import multiprocessing
+import operator
+import os
 import re
+import tempfile
 import numpy as np
+import util
+
+def line_words(line):
+    line = line.lower()
+    if '\t' in line:
+        line = line[(line.index('\t') + 1):]
+    return re.findall(r'\w+', line)
+
+def count_line(line, unigram_stat, bigram_stat):
+    words = line_words(line)
+    for i, word in enumerate(words):
+        unigram_stat[word] += 1
+        if (i + 1) <= (len(words) - 1):
+            bigram_stat[word][words[i + 1]] += 1
+
+def count_shard(shard):
+    """
+    Counts the lines starting in the byte range [start, end) of the file
+    """
+    filename, start, end = shard
+    unigram_stat = defaultdict(int)
+    bigram_stat = defaultdict(functools.partial(defaultdict, int))
+    with open(filename, 'rb') as file:
+        pos = start
+        if start > 0:
+            # the line crossing start belongs to the previous shard
+            file.seek(start - 1)
+            pos += len(file.readline()) - 1
+        while pos < end:
+            line = file.readline()
+            if not line:
+                break
+            pos += len(line)
+            # universal newlines, as the text mode file of the serial build
+            text = line.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+            for part in text.split('\n'):
+                count_line(part, unigram_stat, bigram_stat)
+    return unigram_stat, bigram_stat
+
+def write_run(counts, filename):
+    with open(filename, 'w', encoding='utf-8') as file:
+        for key in sorted(counts):
+            file.write(key + '\t' + str(counts[key]) + '\n')
+
+def read_run(filename):
+    with open(filename, 'r', encoding='utf-8') as file:
+        for line in file:
+            key, cnt = line.rstrip('\n').split('\t')
+            yield key, int(cnt)
+
+def merge_runs(runs, min_count=1):
+    """
+    K-way merges sorted (key, count) runs, sums the counts of equal keys
+    and drops keys with a total count under min_count
+    """
+    for key, group in itertools.groupby(heapq.merge(*runs), key=operator.itemgetter(0)):
+        cnt = sum(cnt for _, cnt in group)
+        if cnt >= min_count:
+            yield key, cnt
+
+class UnigramWeights(dict):
+    """
+    Unigram weights -log(cnt / (all_entries + alpha)) stored for the all_entries of calc_weights()
+    and one shift, log(all_entries + alpha) - log(old all_entries + alpha), added on lookup.
+    A change of all_entries then updates the shift instead of every weight.
+    Unknown words get default and are not inserted. Assign with set_weight(), not [].
+    """
+    def __init__(self, default, items=()):
+        super().__init__(items)
+        self.default = default
+        self.shift = 0.0
+
+    def __getitem__(self, word):
+        weight = dict.get(self, word)
+        return self.default if weight is None else weight + self.shift
+
+    def get(self, word, default=None):
+        weight = dict.get(self, word)
+        return default if weight is None else weight + self.shift
+
+    def set_weight(self, word, weight):
+        dict.__setitem__(self, word, weight - self.shift)
+
+    def items(self):
+        return ((word, weight + self.shift) for word, weight in dict.items(self))
+
+    def values(self):
+        return (weight + self.shift for weight in dict.values(self))
+
+    def __reduce__(self):
+        # pickle the stored weights, items() would add the shift twice
+        return (type(self), (self.default, list(dict.items(self))), {'shift': self.shift})
 
 class LanguageModel:
     def __init__(self):
@@ -12,6 +112,8 @@ class LanguageModel:
         self.unigram_weights = defaultdict(functools.partial(defaultdict, float))
         self.unigram_def_value = None
         self.bigram_dict = {}
+        self._fingerprint = None
+        self._predecessors = None
 
     def update_unigram_stat(self, word):
         self.unigram_stat[word] += 1
@@ -20,23 +122,93 @@ class LanguageModel:
         words = bigram.split('|')
         self.bigram_stat[words[0]][words[1]] += 1
     
-    def build_from_file(self, filename):
-        idx_line = 1
-        with open(filename, 'r', encoding='utf-8') as file:
-            for line in file:
-                line = line.lower()
-                if '\t' in line:
-                    line = line[(line.index('\t') + 1):]
-                words = re.findall(r'\w+', line)
-                for i, word in enumerate(words):
-                    self.unigram_stat[word] += 1
-                    if (i + 1) <= (len(words) - 1):
-                        self.bigram_stat[word][words[i + 1]] += 1
-                idx_line += 1
+    def build_from_file(self, filename, workers=1):
+        """
+        workers > 1 counts byte ranges of the file in worker processes,
+        the counts and the key order are the same as with one worker
+        """
+        if workers > 1:
+            self._count_file_parallel(filename, workers)
+        else:
+            with open(filename, 'r', encoding='utf-8') as file:
+                for line in file:
+                    count_line(line, self.unigram_stat, self.bigram_stat)
         
         #self.build_bigram_dict()
         self.calc_weights()
 
+    def build_from_file_external(self, filename, max_entries=10_000_000, min_count=1, tmp_dir=None):
+        """
+        Counts n-grams with bounded memory: when max_entries distinct unigrams and bigrams are held,
+        the counts are written to sorted run files in tmp_dir, and the runs are merged at the end.
+        N-grams seen fewer than min_count times are dropped during the merge and do not count in the weights.
+        Keys are inserted in sorted order instead of the order of the file.
+        """
+        unigram_stat = Counter()
+        bigram_stat = Counter()
+        unigram_runs = []
+        bigram_runs = []
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+            with open(filename, 'r', encoding='utf-8') as file:
+                for line in file:
+                    words = line_words(line)
+                    for i, word in enumerate(words):
+                        unigram_stat[word] += 1
+                        if (i + 1) <= (len(words) - 1):
+                            bigram_stat[word + ' ' + words[i + 1]] += 1
+                    if len(unigram_stat) + len(bigram_stat) >= max_entries:
+                        for counts, runs in ((unigram_stat, unigram_runs), (bigram_stat, bigram_runs)):
+                            runs.append(os.path.join(run_dir, str(len(unigram_runs) + len(bigram_runs))))
+                            write_run(counts, runs[-1])
+                            counts.clear()
+
+            # the counts still in memory are the last run
+            for key, cnt in merge_runs([read_run(run) for run in unigram_runs] + [sorted(unigram_stat.items())],
+                                       min_count):
+                self.unigram_stat[key] = cnt
+            unigram_stat.clear()
+            # a bigram is not more frequent than its words, so pruning never keeps a bigram of a pruned word
+            for key, cnt in merge_runs([read_run(run) for run in bigram_runs] + [sorted(bigram_stat.items())],
+                                       min_count):
+                word1, word2 = key.split(' ')
+                self.bigram_stat[word1][word2] = cnt
+            bigram_stat.clear()
+
+        self.calc_weights()
+
+    def _count_file_parallel(self, filename, workers):
+        size = os.path.getsize(filename)
+        shards = [(filename, size * i // workers, size * (i + 1) // workers) for i in range(workers)]
+        with multiprocessing.Pool(workers) as pool:
+            # merged in file order, so new keys are inserted in the order of the serial build
+            for unigram_stat, bigram_stat in pool.imap(count_shard, shards):
+                for word, cnt in unigram_stat.items():
+                    self.unigram_stat[word] += cnt
+                for word1, word2_dict in bigram_stat.items():
+                    row = self.bigram_stat[word1]
+                    for word2, cnt in word2_dict.items():
+                        row[word2] += cnt
+
+    def pruned(self, min_unigram_count=1, min_bigram_count=1):
+        """
+        Returns a new model without the words and bigrams seen fewer times than the min counts.
+        The weights are recalculated, so the pruned counts do not count in the normalizer.
+        """
+        lm = LanguageModel()
+        lm.alpha = self.alpha
+        for word, cnt in self.unigram_stat.items():
+            if cnt >= max(min_unigram_count, 1):
+                lm.unigram_stat[word] = cnt
+        for word1, word2_dict in self.bigram_stat.items():
+            if word1 not in lm.unigram_stat:
+                continue
+            row = {word2: cnt for word2, cnt in word2_dict.items()
+                   if cnt >= max(min_bigram_count, 1) and word2 in lm.unigram_stat}
+            if row:
+                lm.bigram_stat[word1].update(row)
+        lm.calc_weights()
+        return lm
+
     def build_bigram_dict(self):
         all_entries = np.sum(list(self.unigram_stat.values()))
         for w1, w1_dict in self.bigram_stat.items():
@@ -46,13 +218,398 @@ class LanguageModel:
                 if p_independent < p_together:
                     self.bigram_dict[(w1, w2)] = p_together / all_entries
 
+    def fingerprint(self):
+        # identifies the vocabulary and counts that derived indexes were built from
+        if getattr(self, '_fingerprint', None) is None:
+            digest = hashlib.sha256()
+            for word in sorted(w for w, cnt in self.unigram_stat.items() if cnt > 0):
+                digest.update(word.encode('utf-8'))
+                digest.update(b'\t%d\n' % self.unigram_stat[word])
+            self._fingerprint = digest.digest()
+        return self._fingerprint
+
+    def unigram_weight_shift(self):
+        # added to the stored unigram weights on lookup, see UnigramWeights
+        return getattr(self.unigram_weights, 'shift', 0.0)
+
+    def predecessors(self):
+        """
+        Reverse bigram index, the words that precede a word in bigram_stat.
+        Built on first use and kept up to date by update_counts().
+        """
+        if getattr(self, '_predecessors', None) is None:
+            self._predecessors = defaultdict(set)
+            for word1, word2_dict in self.bigram_stat.items():
+                for word2 in word2_dict:
+                    self._predecessors[word2].add(word1)
+        return self._predecessors
+
     def calc_weights(self):
+        self._fingerprint = None
+        self._predecessors = None
         all_entries = np.sum(list(self.unigram_stat.values()))
+        self.all_entries = all_entries
         self.unigram_def_value = -np.log(self.alpha / (all_entries + self.alpha * len(self.unigram_stat)))
-        self.unigram_weights = defaultdict(functools.partial(float, self.unigram_def_value))
+        self.unigram_weights = UnigramWeights(self.unigram_def_value)
         for word, cnt in self.unigram_stat.items():
-            self.unigram_weights[word] = -np.log(cnt / (all_entries + self.alpha))
+            self.unigram_weights.set_weight(word, -np.log(cnt / (all_entries + self.alpha)))
         
         for word1, word2_dict in self.bigram_stat.items():
             for word2, cnt in word2_dict.items():
                 self.bigram_weights[word1][word2] = - np.log(cnt / self.unigram_stat[word1])
+
+    def update_counts(self, unigram_delta, bigram_delta=None):
+        """
+        Adds count deltas (negative ones decrease counts) and refreshes the weights of touched words.
+        Words whose count falls to zero are removed with their bigrams, the ones they start and the ones
+        leading to them, found by the predecessors() index.
+        The change of all_entries is one shift of every unigram weight, so the cost depends
+        on the size of the delta and the bigram rows of touched words, not on the size of the model.
+        Returns the sets of added, removed and updated words.
+        """
+        bigram_delta = bigram_delta if bigram_delta is not None else {}
+        added, removed, updated = set(), set(), set()
+        all_entries = getattr(self, 'all_entries', None)
+        if all_entries is None:
+            all_entries = np.sum(list(self.unigram_stat.values()))
+        if not isinstance(self.unigram_weights, UnigramWeights):
+            # models saved before UnigramWeights, converted once
+            self.unigram_weights = UnigramWeights(self.unigram_def_value, self.unigram_weights.items())
+        old_all_entries = all_entries
+        for word, delta in unigram_delta.items():
+            old_cnt = self.unigram_stat.get(word, 0)
+            cnt = max(old_cnt + delta, 0)
+            all_entries += cnt - old_cnt
+            if cnt > 0:
+                self.unigram_stat[word] = cnt
+                (updated if old_cnt > 0 else added).add(word)
+            elif old_cnt > 0:
+                removed.add(word)
+        predecessors = self.predecessors()
+        touched_rows = set()
+        for word in removed:
+            del self.unigram_stat[word]
+            self.unigram_weights.pop(word, None)
+            for word2 in self.bigram_stat.pop(word, {}):
+                predecessors[word2].discard(word)
+            self.bigram_weights.pop(word, None)
+            for word1 in predecessors.pop(word, ()):
+                if word1 in self.bigram_stat:
+                    self.bigram_stat[word1].pop(word, None)
+                    self.bigram_weights[word1].pop(word, None)
+                    touched_rows.add(word1)
+
+        self.all_entries = all_entries
+        self.unigram_def_value = -np.log(self.alpha / (all_entries + self.alpha * len(self.unigram_stat)))
+        self.unigram_weights.default = self.unigram_def_value
+        self.unigram_weights.shift += np.log(all_entries + self.alpha) - np.log(old_all_entries + self.alpha)
+        for word in added | updated:
+            self.unigram_weights.set_weight(word, -np.log(self.unigram_stat[word] / (all_entries + self.alpha)))
+
+        touched_rows |= added | updated
+        for (word1, word2), delta in bigram_delta.items():
+            if self.unigram_stat.get(word1, 0) == 0 or self.unigram_stat.get(word2, 0) == 0:
+                continue
+            cnt = self.bigram_stat[word1].get(word2, 0) + delta
+            if cnt > 0:
+                self.bigram_stat[word1][word2] = cnt
+                predecessors[word2].add(word1)
+            else:
+                self.bigram_stat[word1].pop(word2, None)
+                self.bigram_weights[word1].pop(word2, None)
+                predecessors[word2].discard(word1)
+            touched_rows.add(word1)
+        # bigram weights are normalized by the count of the first word
+        for word1 in touched_rows:
+            if word1 in self.bigram_stat and word1 in self.unigram_stat:
+                for word2, cnt in self.bigram_stat[word1].items():
+                    self.bigram_weights[word1][word2] = - np.log(cnt / self.unigram_stat[word1])
+
+        self._fingerprint = None
+        return added, removed, updated
+
+    def frozen(self):
+        return FrozenLanguageModel(self)
+
+    def update_from_file(self, filename):
+        """
+        Adds the counts of a query log, e.g. one day of queries, see update_counts().
+        The weights then equal those of a model built from all the logs, up to float rounding.
+        """
+        unigram_delta = defaultdict(int)
+        bigram_stat = defaultdict(functools.partial(defaultdict, int))
+        with open(filename, 'r', encoding='utf-8') as file:
+            for line in file:
+                count_line(line, unigram_delta, bigram_stat)
+        bigram_delta = {(word1, word2): cnt for word1, word2_dict in bigram_stat.items()
+                        for word2, cnt in word2_dict.items()}
+        return self.update_counts(unigram_delta, bigram_delta)
+
+    @staticmethod
+    def read_delta_file(filename):
+        """
+        Reads count deltas, one per line: "word<TAB>count" or "word1 word2<TAB>count"
+        """
+        unigram_delta = Counter()
+        bigram_delta = Counter()
+        with open(filename, 'r', encoding='utf-8') as file:
+            for line in file:
+                line = line.rstrip('\n')
+                if '\t' not in line:
+                    continue
+                key, cnt = line.lower().rsplit('\t', 1)
+                words = key.split()
+                if len(words) == 1:
+                    unigram_delta[words[0]] += int(cnt)
+                elif len(words) == 2:
+                    bigram_delta[(words[0], words[1])] += int(cnt)
+        return unigram_delta, bigram_delta
+
+class FrozenMapping:
+    """
+    Read-only view of a dict attribute of a LanguageModel that returns default for missing keys.
+    The attribute is looked up on every access, so the view follows calc_weights() and update_counts().
+    """
+    def __init__(self, language_model, name, default=None, wrap=None):
+        self.language_model = language_model
+        self.name = name
+        self.default = default
+        self.wrap = wrap
+
+    def __getitem__(self, key):
+        value = getattr(self.language_model, self.name).get(key)
+        if value is None:
+            return self.default() if callable(self.default) else self.default
+        return value if self.wrap is None else self.wrap(value)
+
+    def get(self, key, default=None):
+        value = getattr(self.language_model, self.name).get(key)
+        if value is None:
+            return default
+        return value if self.wrap is None else self.wrap(value)
+
+    def __contains__(self, key):
+        return key in getattr(self.language_model, self.name)
+
+    def __iter__(self):
+        return iter(getattr(self.language_model, self.name))
+
+    def __len__(self):
+        return len(getattr(self.language_model, self.name))
+
+    def keys(self):
+        return getattr(self.language_model, self.name).keys()
+
+    def items(self):
+        if self.wrap is None:
+            return getattr(self.language_model, self.name).items()
+        return ((key, self.wrap(value)) for key, value in getattr(self.language_model, self.name).items())
+
+class FrozenRow:
+    """Read-only view of a bigram row, 0.0 for unseen successors"""
+    def __init__(self, row):
+        self.row = row
+
+    def __getitem__(self, word):
+        return self.row.get(word, 0.0)
+
+    def get(self, word, default=None):
+        return self.row.get(word, default)
+
+    def __contains__(self, word):
+        return word in self.row
+
+    def items(self):
+        return self.row.items()
+
+class FrozenLanguageModel:
+    """
+    LanguageModel for serving: looking up unseen words and bigrams returns the defaults
+    of the LanguageModel without inserting them, so the model does not grow with the queries.
+    Explicit updates (update_counts, calc_weights) go to the wrapped model.
+    """
+    def __init__(self, language_model):
+        self.language_model = language_model
+        self.unigram_stat = FrozenMapping(language_model, 'unigram_stat', 0)
+        self.unigram_weights = FrozenMapping(language_model, 'unigram_weights',
+                                             lambda: language_model.unigram_def_value)
+        self.bigram_stat = FrozenMapping(language_model, 'bigram_stat', FrozenRow({}), FrozenRow)
+        self.bigram_weights = FrozenMapping(language_model, 'bigram_weights', FrozenRow({}), FrozenRow)
+
+    def __getattr__(self, name):
+        # alpha, unigram_def_value, fingerprint(), update_counts() and the rest of LanguageModel
+        if name == 'language_model':
+            raise AttributeError(name)
+        return getattr(self.language_model, name)
+
+class VocabularyArray:
+    """
+    Read-only mapping of words to the items of an array indexed by word id.
+    Unknown words map to default and are not inserted.
+    """
+    def __init__(self, word_ids, values, default):
+        self.word_ids = word_ids
+        self.data = values
+        self.default = default
+
+    def __getitem__(self, word):
+        word_id = self.word_ids.get(word)
+        return self.default if word_id is None else self.data[word_id].item()
+
+    def get(self, word, default=None):
+        word_id = self.word_ids.get(word)
+        return default if word_id is None else self.data[word_id].item()
+
+    def __contains__(self, word):
+        return word in self.word_ids
+
+    def __iter__(self):
+        return iter(self.word_ids)
+
+    def __len__(self):
+        return len(self.word_ids)
+
+    def keys(self):
+        return self.word_ids.keys()
+
+    def values(self):
+        return self.data.tolist()
+
+    def items(self):
+        return zip(self.word_ids, self.data.tolist())
+
+class BigramRow:
+    """Read-only mapping of the successors of one word to bigram weights, 0.0 for unseen bigrams"""
+    def __init__(self, language_model, word_id):
+        self.language_model = language_model
+        self.word_id = word_id
+
+    def __getitem__(self, word):
+        return self.get(word, 0.0)
+
+    def get(self, word, default=None):
+        word_id = self.language_model.word_ids.get(word)
+        if self.word_id is None or word_id is None:
+            return default
+        weight = self.language_model.bigram_weight_by_id(self.word_id, word_id)
+        return default if weight is None else weight
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def items(self):
+        if self.word_id is None:
+            return []
+        lm = self.language_model
+        lo, hi = lm.bigram_offsets[self.word_id], lm.bigram_offsets[self.word_id + 1]
+        return [(lm.words[w], weight) for w, weight in zip(lm.bigram_successors[lo:hi].tolist(),
+                                                           lm.bigram_weight_array[lo:hi].tolist())]
+
+class BigramRows:
+    def __init__(self, language_model):
+        self.language_model = language_model
+
+    def __getitem__(self, word):
+        return BigramRow(self.language_model, self.language_model.word_ids.get(word))
+
+    def get(self, word, default=None):
+        word_id = self.language_model.word_ids.get(word)
+        return default if word_id is None else BigramRow(self.language_model, word_id)
+
+    def __contains__(self, word):
+        return word in self.language_model.word_ids
+
+class CompactLanguageModel:
+    """
+    Read-only LanguageModel stored in arrays instead of nested dicts.
+    Word ids follow the sorted vocabulary, as the word ids of CompactTrie do.
+    Unigram counts and float32 (or quantized to bits) weights are indexed by word id, bigrams are CSR rows:
+    the successors of word i are bigram_successors[bigram_offsets[i]:bigram_offsets[i+1]], sorted by id.
+    unigram_stat, unigram_weights and bigram_weights are lookup views with the defaults of LanguageModel,
+    so the model can be passed to util.evaluate_words_nll, Trie and the fix generators.
+    """
+    def __init__(self, language_model, bits=None):
+        unigram_stat = language_model.unigram_stat
+        self.alpha = language_model.alpha
+        self.unigram_def_value = language_model.unigram_def_value
+        self.all_entries = getattr(language_model, 'all_entries', None)
+        self.words = sorted(w for w, cnt in unigram_stat.items() if cnt > 0)
+        self.word_ids = {w: i for i, w in enumerate(self.words)}
+        self.unigram_counts = np.array([unigram_stat[w] for w in self.words], dtype=np.int64)
+        self.unigram_weight_array = np.array([language_model.unigram_weights[w] for w in self.words],
+                                             dtype=np.float32)
+
+        bigram_offsets = np.zeros(len(self.words) + 1, dtype=np.int64)
+        successors = array('i')
+        weights = array('f')
+        for word_id, word in enumerate(self.words):
+            row = language_model.bigram_weights.get(word)
+            if row:
+                for successor_id, weight in sorted((self.word_ids[w], weight) for w, weight in row.items()
+                                                   if w in self.word_ids):
+                    successors.append(successor_id)
+                    weights.append(weight)
+            bigram_offsets[word_id + 1] = len(successors)
+        self.bigram_offsets = bigram_offsets
+        self.bigram_successors = np.frombuffer(successors, dtype=np.int32).copy()
+        self.bigram_weight_array = np.frombuffer(weights, dtype=np.float32).copy()
+        if bits is not None:
+            # 8 or 16-bit codes into a table of levels instead of float32 weights
+            self.unigram_weight_array = util.QuantizedArray(self.unigram_weight_array, bits)
+            self.bigram_weight_array = util.QuantizedArray(self.bigram_weight_array, bits)
+        self._fingerprint = language_model.fingerprint()
+        self._init_views()
+
+    @classmethod
+    def from_arrays(cls, words, unigram_counts, unigram_weights, bigram_offsets, bigram_successors, bigram_weights,
+                    alpha, unigram_def_value, all_entries, fingerprint):
+        """
+        Creates the model over existing arrays without copying them, e.g. arrays mapped from a ModelBundle
+        """
+        lm = cls.__new__(cls)
+        lm.alpha = alpha
+        lm.unigram_def_value = unigram_def_value
+        lm.all_entries = all_entries
+        lm.words = words
+        lm.word_ids = {w: i for i, w in enumerate(words)}
+        lm.unigram_counts = unigram_counts
+        lm.unigram_weight_array = unigram_weights.astype(np.float32, copy=False)
+        lm.bigram_offsets = bigram_offsets
+        lm.bigram_successors = bigram_successors.astype(np.int32, copy=False)
+        lm.bigram_weight_array = bigram_weights.astype(np.float32, copy=False)
+        lm._fingerprint = fingerprint
+        lm._init_views()
+        return lm
+
+    def _init_views(self):
+        self._bigram_keys = None
+        self.unigram_stat = VocabularyArray(self.word_ids, self.unigram_counts, 0)
+        self.unigram_weights = VocabularyArray(self.word_ids, self.unigram_weight_array, self.unigram_def_value)
+        self.bigram_weights = BigramRows(self)
+
+    def bigram_keys(self):
+        # word_id1 * vocabulary size + word_id2 of every bigram, sorted as the CSR rows are
+        if self._bigram_keys is None:
+            rows = np.repeat(np.arange(len(self.words), dtype=np.int64), np.diff(self.bigram_offsets))
+            self._bigram_keys = rows * len(self.words) + self.bigram_successors
+        return self._bigram_keys
+
+    def bigram_weight_by_id(self, word_id1, word_id2):
+        lo, hi = self.bigram_offsets[word_id1], self.bigram_offsets[word_id1 + 1]
+        i = lo + np.searchsorted(self.bigram_successors[lo:hi], word_id2)
+        if i < hi and self.bigram_successors[i] == word_id2:
+            return self.bigram_weight_array[i].item()
+        return None
+
+    def fingerprint(self):
+        return self._fingerprint
+
+    def unigram_weight_shift(self):
+        return 0.0
+
+    def update_counts(self, unigram_delta, bigram_delta=None):
+        raise TypeError("CompactLanguageModel is read-only, update the LanguageModel and convert it again")
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.unigram_counts, self.unigram_weight_array, self.bigram_offsets,
+                                      self.bigram_successors, self.bigram_weight_array))
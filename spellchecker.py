@@ -1,8 +1,11 @@
 import pickle
 from collections import defaultdict
 from error_model import ErrorModel
-from language_model import LanguageModel
-from trie import Trie, Candidate
+from language_model import LanguageModel, CompactLanguageModel
+from trie import Trie, Candidate, SearchProfile
+from compact_trie import CompactTrie
+from bundle import ModelBundle
+from symspell import SymmetricDeleteIndex
 import numpy as np
 from fix_generators import join_generator, split_generator, word_generator, join_generator_simple
 from fix_generators import def_is_estimated_token, def_is_spec_join_token
@@ -10,15 +13,49 @@ from fix_generators import preprocess_req, keyboard_layout_generator, split_gene
 from classifiers import stat_clf
 import sys
 import copy 
+import signal
 import util
 
 class Spellchecker:
-    def __init__(self, language_model, trie, clf):
+    def __init__(self, language_model, trie, clf, long_word_index=None, long_word_len=8):
          self.language_model = language_model
          self.trie = trie
          self.clf = clf
+         self.long_word_index = long_word_index
+         self.long_word_len = long_word_len
+         self.nll_memo = None
+         # 'beam' or 'viterbi', see word_generator
+         self.decoder = 'beam'
          pass
 
+    def enable_scoring_memo(self, capacity=None):
+        """
+        Memoizes the stat_clf scores of candidate requests during a request, and across requests up to capacity
+        """
+        self.nll_memo = util.NllMemo(capacity)
+        self.language_model.nll_memo = self.nll_memo
+
+    def apply_delta(self, filename):
+        """
+        Applies a file of count deltas (see LanguageModel.read_delta_file) to the running models.
+        A CompactLanguageModel is read-only, its deltas are rejected with TypeError and nothing changes.
+        """
+        if isinstance(self.language_model, CompactLanguageModel):
+            raise TypeError(filename + ": deltas cannot be applied to a CompactLanguageModel, rebuild the model bundle")
+        unigram_delta, bigram_delta = LanguageModel.read_delta_file(filename)
+        added, removed, updated = self.language_model.update_counts(unigram_delta, bigram_delta)
+        for word in removed:
+            self.trie.remove(word)
+        for word in updated:
+            self.trie.update_weight(word)
+        for word in added:
+            self.trie.add(word)
+            if self.long_word_index is not None:
+                self.long_word_index.add(word)
+        if self.nll_memo is not None:
+            self.nll_memo.clear()
+        return added, removed, updated
+
     def safe_correction(self, orig_request, iterations=1, max_candidates=5):
         try:
             return self.correction(orig_request, iterations, max_candidates)
@@ -29,6 +66,8 @@ class Spellchecker:
         return orig_request
 
     def correction(self, orig_request, iterations=1, max_candidates=5):
+        if self.nll_memo is not None:
+            self.nll_memo.start_request()
         requests = set([orig_request])
         old_requests =  {}
         accumulated_errors = defaultdict(float)
@@ -48,7 +87,8 @@ class Spellchecker:
                 if fix_req_spec_join:
                     return fix_req_spec_join
 
-                res = word_generator(tokens, self.language_model, self.trie, max_candidates)
+                res = word_generator(tokens, self.language_model, self.trie, max_candidates,
+                                     self.long_word_index, self.long_word_len, decoder=self.decoder)
                 for fix_req_w, fix_list in res:
                     if fix_req_w not in old_requests:
                         req_error = self.clf(fix_list, self.language_model)
@@ -58,7 +98,7 @@ class Spellchecker:
                         new_requests.add(fix_req_w)
                 
                 #fix_req_s = split_generator(req.lower(), self.language_model)
-                res = split_generator_complex(req, self.language_model)
+                res = split_generator_complex(req, self.language_model, self.trie)
                 if res:
                     fix_req_s = res[0]
                     fix_list = res[1]
@@ -92,31 +132,97 @@ class Spellchecker:
 if __name__ == '__main__':
     try:
         print("1", file=sys.stderr)
-        print("Start LanguageModel loading", file=sys.stderr)
-        lm = util.load_obj('lm')
+        try:
+            print("Start model bundle loading", file=sys.stderr)
+            bundle = ModelBundle('model.bundle')
+            # arrays instead of nested dicts, deltas cannot be applied
+            lm = bundle.language_model(compact='--compact-lm' in sys.argv)
+            em = bundle.error_model()
+        except (OSError, ValueError) as err:
+            print(err, file=sys.stderr)
+            bundle = None
+            print("Start LanguageModel loading", file=sys.stderr)
+            lm = util.load_obj('lm')
+            if '--compact-lm' in sys.argv:
+                lm = CompactLanguageModel(lm)
 
-        print("Start ErrorModel loading", file=sys.stderr)
-        em = util.load_obj('em')
+            print("Start ErrorModel loading", file=sys.stderr)
+            em = util.load_obj('em')
+        if not isinstance(lm, CompactLanguageModel):
+            # unseen words of the queries must not be inserted into the model
+            lm = lm.frozen()
 
-        print("Start Trie building", file=sys.stderr)
-        trie_spellcheck = Trie(em, lm)
-        trie_spellcheck.build()
+        print("Start Trie loading", file=sys.stderr)
+        trie_spellcheck = None
+        if bundle is not None and 'trie' in bundle:
+            try:
+                trie_spellcheck = bundle.trie(em, lm)
+            except ValueError as err:
+                print(err, file=sys.stderr)
+        if trie_spellcheck is None:
+            print("Start Trie building", file=sys.stderr)
+            trie_spellcheck = CompactTrie(em, lm)
+            trie_spellcheck.build()
+        # the same misspelled words come again and again, keep up to 1M candidates
+        trie_spellcheck.enable_cache(1_000_000)
+        # garbage input must not grow the search queue past max_queue_size
+        trie_spellcheck.bounded = True
+        if '--profile' in sys.argv:
+            trie_spellcheck.search_profile = SearchProfile()
+        if '--hot-tier' in sys.argv:
+            # most corrections are frequent words, search them in a small trie first
+            print("Start hot tier building", file=sys.stderr)
+            trie_spellcheck.build_hot_tier(50_000)
         
+        print("Start SymmetricDeleteIndex loading", file=sys.stderr)
+        long_word_index = None
+        if bundle is not None and 'symspell.meta' in bundle:
+            try:
+                long_word_index = bundle.long_word_index(trie_spellcheck)
+            except ValueError as err:
+                print(err, file=sys.stderr)
+        if long_word_index is None:
+            print("Start SymmetricDeleteIndex building", file=sys.stderr)
+            long_word_index = SymmetricDeleteIndex(trie_spellcheck)
+            long_word_index.build()
+
         print("Spellchecker init", file=sys.stderr)
-        spellchecker = Spellchecker(lm, trie_spellcheck, stat_clf)
+        spellchecker = Spellchecker(lm, trie_spellcheck, stat_clf, long_word_index, long_word_index.long_word_len)
+        # a request scores a few candidate requests, keep those of the last twenty thousand or so
+        spellchecker.enable_scoring_memo(100_000)
+        if '--viterbi' in sys.argv:
+            spellchecker.decoder = 'viterbi'
 
         print("Spellchecker start", file=sys.stderr)
 
+        # SIGHUP applies delta.txt between two queries
+        delta_requested = []
+        signal.signal(signal.SIGHUP, lambda signum, frame: delta_requested.append(signum))
+
         while True:
             try:
                 query = input()
             except EOFError:
                 break
+            if delta_requested:
+                delta_requested.clear()
+                try:
+                    added, removed, updated = spellchecker.apply_delta('delta.txt')
+                    print("Delta applied: " + str(len(added)) + " added, " + str(len(removed)) + " removed, "
+                          + str(len(updated)) + " updated", file=sys.stderr)
+                except (OSError, ValueError, TypeError) as err:
+                    print(err, file=sys.stderr)
             try:
                 result = spellchecker.safe_correction(query, max_candidates=5, iterations=2)
                 print(result)
             except:
                 print(query)
+        print("Candidates cache: " + str(trie_spellcheck.cache.stats()), file=sys.stderr)
+        if trie_spellcheck.hot_tier is not None:
+            print("Dictionary tiers: " + str(trie_spellcheck.tier_stats()), file=sys.stderr)
+        print("Scoring memo: " + str(spellchecker.nll_memo.stats()), file=sys.stderr)
+        if trie_spellcheck.search_profile is not None:
+            print(trie_spellcheck.search_profile.report(), file=sys.stderr)
     except RuntimeError as err:
         print(err, file=sys.stderr)
     except:
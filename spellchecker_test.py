@@ -1,17 +1,21 @@
 from spellchecker import Spellchecker
 import pickle
 from error_model import ErrorModel
-from language_model import LanguageModel
+from language_model import LanguageModel, CompactLanguageModel
 from trie import Trie
+from compact_trie import CompactTrie
 import numpy as np
 from fix_generators import join_generator, split_generator, word_generator
 from fix_generators import keyboard_layout_generator
 from fix_generators import preprocess_req
+import fix_generators
 from classifiers import stat_clf
 import sys
 import copy
 import time 
 import util
+import os
+import tempfile
 
 def build_test():
     fix_requests = []
@@ -60,6 +64,161 @@ def test_fix(cnt_test, fix_requests):
     acc = (cnt_test - cnt_errors) / cnt_test
     return errors, acc
 
+def current_rss():
+    # resident set size in bytes, Linux only
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def test_rss(checker, cnt_queries, requests, warmup_queries, report_every=250):
+    """
+    Replays requests with a random garbage word appended through checker.safe_correction and samples RSS.
+    The bounded caches fill up during the first warmup_queries, after that RSS must stay flat
+    with a frozen language model. Returns the samples and the growth after warm-up.
+    """
+    samples = []
+    rng = np.random.default_rng(0)
+    letters = list('abcdefghijklmnopqrstuvwxyz')
+    for i in range(cnt_queries + 1):
+        if i % report_every == 0:
+            samples.append((i, current_rss()))
+            print(str(i) + " queries, RSS " + str(samples[-1][1] // 2**20) + " MB", file=sys.stderr)
+        if i == cnt_queries:
+            break
+        query = requests[i % len(requests)] + ' ' + ''.join(rng.choice(letters, 8))
+        checker.safe_correction(query, max_candidates=5, iterations=2)
+    warm_rss = max(rss for i, rss in samples if i <= warmup_queries)
+    growth = max(rss for _, rss in samples) - warm_rss
+    return samples, growth
+
+def test_apply_delta_compact(lm, em, requests, cnt_test=100):
+    """
+    Sends a delta to a spellchecker over a CompactLanguageModel, as SIGHUP does in the server.
+    It must be rejected with TypeError, leaving the trie and the corrections of requests unchanged.
+    """
+    compact_lm = CompactLanguageModel(lm)
+    trie = CompactTrie(em, compact_lm)
+    trie.build()
+    checker = Spellchecker(compact_lm, trie, stat_clf)
+    requests = requests[:cnt_test]
+    before = [checker.safe_correction(req, max_candidates=5) for req in requests]
+    version = trie.version
+
+    fd, delta_file = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write("новоеслово\t100\n" + compact_lm.words[0] + "\t-1000000\n")
+    try:
+        checker.apply_delta(delta_file)
+        rejected = False
+    except TypeError as err:
+        print(err, file=sys.stderr)
+        rejected = True
+    finally:
+        os.remove(delta_file)
+
+    after = [checker.safe_correction(req, max_candidates=5) for req in requests]
+    unchanged = trie.version == version and before == after
+    return rejected, unchanged
+
+def test_incremental_update(log_a, log_b, log_ab, em, words, tol=1e-9, cnt_removed=20):
+    """
+    Builds a LanguageModel and a CompactTrie from log_a, then adds log_b with update_from_file.
+    The weights must equal those of a model built from log_ab up to float rounding, and the A* search
+    over the updated trie must find candidates of the same weights as a trie built from that model
+    (words of equal weight may differ). Then the cnt_removed words with the most predecessors are removed
+    by negative deltas, no bigram from or to them may be left and pairs ending with them must score
+    as unknown words. Returns the largest weight difference, the number of words with different candidates
+    and the number of removed words left in the model or the trie.
+    """
+    lm = LanguageModel()
+    lm.build_from_file(log_a)
+    trie = CompactTrie(em, lm)
+    trie.build()
+    added, removed, updated = lm.update_from_file(log_b)
+    for word in removed:
+        trie.remove(word)
+    for word in updated:
+        trie.update_weight(word)
+    for word in added:
+        trie.add(word)
+
+    full_lm = LanguageModel()
+    full_lm.build_from_file(log_ab)
+    full_trie = CompactTrie(em, full_lm)
+    full_trie.build()
+
+    max_diff = abs(lm.unigram_def_value - full_lm.unigram_def_value)
+    for word, weight in full_lm.unigram_weights.items():
+        max_diff = max(max_diff, abs(lm.unigram_weights[word] - weight))
+    for word1, row in full_lm.bigram_weights.items():
+        for word2, weight in row.items():
+            max_diff = max(max_diff, abs(lm.bigram_weights[word1][word2] - weight))
+
+    trie.astar = full_trie.astar = True
+    cnt_diff = 0
+    for word in words:
+        weights = sorted(c.weight for c in trie.find_candidates(word).values())
+        full_weights = sorted(c.weight for c in full_trie.find_candidates(word).values())
+        if len(weights) != len(full_weights) or any(abs(w1 - w2) > tol for w1, w2 in zip(weights, full_weights)):
+            cnt_diff += 1
+
+    predecessors = lm.predecessors()
+    removed_words = sorted(lm.unigram_stat, key=lambda w: (-len(predecessors.get(w, ())), w))[:cnt_removed]
+    word_predecessors = {word: sorted(predecessors.get(word, set()) - set(removed_words)) for word in removed_words}
+    added, removed, updated = lm.update_counts({word: -lm.unigram_stat[word] for word in removed_words})
+    for word in removed:
+        trie.remove(word)
+    for word in updated:
+        trie.update_weight(word)
+    # the frozen model does not insert the words it looks up
+    frozen_lm = lm.frozen()
+    cnt_left = 0
+    for word in removed_words:
+        left = word in lm.bigram_stat or word in trie \
+            or any(word in row for row in lm.bigram_stat.values()) \
+            or any(word in row for row in lm.bigram_weights.values()) \
+            or any(abs(util.evaluate_words_nll([word1, word], frozen_lm) - util.evaluate_words_nll([word1], frozen_lm)
+                       - frozen_lm.unigram_def_value) > tol for word1 in word_predecessors[word])
+        cnt_left += left
+    return max_diff, cnt_diff, cnt_left
+
+def compaction_report(lm, em, requests, settings, cnt_test=1000):
+    """
+    Prints the memory of the compacted language model and the accuracy on requests
+    for each (min_unigram_count, min_bigram_count, min_error_count, bits) setting, bits=None keeps float32 weights.
+    Only the language model is compacted: the error model is pruned and rounded to bits as an accuracy
+    simulation, see ErrorModel.quantized, and its memory is not reported.
+    Savings and accuracy changes are against the first setting.
+    """
+    rng = np.random.default_rng(0)
+    indices = rng.choice(len(requests), min(cnt_test, len(requests)), replace=False)
+    base_bytes = base_acc = None
+    report = []
+    print("Memory of the language model, the error model is pruned and rounded as an accuracy simulation")
+    for min_unigram_count, min_bigram_count, min_error_count, bits in settings:
+        compact_lm = CompactLanguageModel(lm.pruned(min_unigram_count, min_bigram_count), bits)
+        compact_em = em.pruned(min_error_count)
+        if bits is not None:
+            # accuracy simulation, the error model keeps float weights
+            compact_em = compact_em.quantized(bits)
+        trie = CompactTrie(compact_em, compact_lm)
+        trie.build()
+        checker = Spellchecker(compact_lm, trie, stat_clf)
+        cnt_correct = 0
+        for idx in indices:
+            orig_req, fix_req = requests[idx]
+            if checker.safe_correction(orig_req, max_candidates=5) == fix_req:
+                cnt_correct += 1
+        lm_bytes = compact_lm.nbytes()
+        acc = cnt_correct / len(indices)
+        if base_bytes is None:
+            base_bytes, base_acc = lm_bytes, acc
+        report.append((min_unigram_count, min_bigram_count, min_error_count, bits, lm_bytes, acc))
+        print("min_unigram_count=%d min_bigram_count=%d min_error_count=%d bits=%s: LM %d bytes (%.1f%% saved), "
+              "%d words, accuracy %.4f (%+.4f)" % (min_unigram_count, min_bigram_count, min_error_count, bits,
+                                                   lm_bytes, 100 * (1 - lm_bytes / base_bytes), len(compact_lm.words),
+                                                   acc, acc - base_acc))
+    return report
+
 if __name__ == '__main__':
     print("Start LanguageModel loading", file=sys.stderr)
     lm = util.load_obj('lm')
@@ -68,7 +227,7 @@ if __name__ == '__main__':
     em = util.load_obj('em')
 
     print("Start Trie building", file=sys.stderr)
-    trie_spellcheck = Trie(em, lm)
+    trie_spellcheck = CompactTrie(em, lm)
     trie_spellcheck.build()
         
     print("Spellchecker init", file=sys.stderr)
@@ -76,6 +235,55 @@ if __name__ == '__main__':
 
     print("Spellchecker start", file=sys.stderr)
 
+    if '--compaction' in sys.argv:
+        settings = [(1, 1, 1, None), (1, 2, 1, None), (1, 1, 1, 16), (1, 1, 1, 8), (2, 2, 2, 16), (2, 2, 2, 8),
+                    (5, 5, 5, 8)]
+        compaction_report(lm, em, util.load_obj('fix_requests'), settings)
+        sys.exit()
+
+    if '--incremental' in sys.argv:
+        # the first half of the log is the model, the second half is the update
+        with open("queries_all.txt", 'r', encoding='utf-8') as file:
+            lines = file.readlines()
+        logs = []
+        for part in (lines[:len(lines) // 2], lines[len(lines) // 2:]):
+            fd, log = tempfile.mkstemp(suffix='.txt')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.writelines(part)
+            logs.append(log)
+        words = [t.token for line in lines[:1000] for t in preprocess_req(line.split('\t')[0]) if t.need_correct]
+        try:
+            max_diff, cnt_diff, cnt_left = test_incremental_update(logs[0], logs[1], "queries_all.txt", em, words)
+        finally:
+            for log in logs:
+                os.remove(log)
+        print("Incremental update: max weight difference " + str(max_diff) + ", "
+              + str(cnt_diff) + "/" + str(len(words)) + " words with other candidates, "
+              + str(cnt_left) + " removed words left")
+        sys.exit()
+
+    if '--delta-compact' in sys.argv:
+        rejected, unchanged = test_apply_delta_compact(lm, em, util.load_obj('none_fix_requests'))
+        print("Delta on CompactLanguageModel: rejected " + str(rejected) + ", models unchanged " + str(unchanged))
+        sys.exit()
+
+    if '--rss' in sys.argv:
+        # the spellchecker of the server with small caches, so they are full after warm-up
+        frozen_lm = lm.frozen()
+        frozen_trie = CompactTrie(em, frozen_lm)
+        frozen_trie.build()
+        frozen_trie.enable_cache(2_000)
+        frozen_trie.bounded = True
+        fix_generators.preprocess_memo = util.LRUCache(2_000)
+        checker = Spellchecker(frozen_lm, frozen_trie, stat_clf)
+        checker.enable_scoring_memo(2_000)
+        max_growth = 2 * 2**20
+        samples, growth = test_rss(checker, 4_000, util.load_obj('none_fix_requests'), 1_000)
+        print("RSS growth after warm-up: " + str(growth / 2**20) + " MB")
+        if growth > max_growth:
+            sys.exit("RSS grew by more than " + str(max_growth // 2**20) + " MB after warm-up")
+        sys.exit()
+
     if False:
         while True:
             query = input()
@@ -0,0 +1,173 @@
+from trie import Candidate
+import numpy as np
+
+class SymmetricDeleteIndex:
+    """
+    Finds words within max_distance edits by symmetric deletes (SymSpell) instead of the trie search.
+    Only the first prefix_length letters of the words are indexed. The short list is ranked
+    by the same error model weights as Trie.find_candidates, so the two engines are interchangeable.
+    The index serves words of long_word_len letters and longer, so words shorter than
+    long_word_len - max_distance are left out: they are never within max_distance of such a word.
+    The deletes are sorted arrays searched in place, see to_arrays and from_arrays.
+    """
+    def __init__(self, trie, max_distance=2, prefix_length=7, long_word_len=8):
+        self.trie = trie
+        self.language_model = trie.language_model
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.long_word_len = long_word_len
+        self.words = []
+        # utf-8 variants sorted by bytes, the word ids of variant i are
+        # delete_word_ids[delete_offsets[i]:delete_offsets[i + 1]]
+        self.variant_data = b''
+        self.variant_offsets = np.zeros(1, dtype=np.int64)
+        self.delete_offsets = np.zeros(1, dtype=np.int64)
+        self.delete_word_ids = np.zeros(0, dtype=np.int32)
+        # variants of the words added after build
+        self.added_deletes = {}
+        self._word_index = None
+
+    def min_word_len(self):
+        return max(self.long_word_len - self.max_distance, 1)
+
+    def build(self):
+        min_word_len = self.min_word_len()
+        self.words = sorted(w for w, cnt in self.language_model.unigram_stat.items()
+                            if cnt > 0 and len(w) >= min_word_len)
+        deletes = {}
+        for word_id, word in enumerate(self.words):
+            for variant in self._deletes(word[:self.prefix_length]):
+                word_ids = deletes.get(variant)
+                if word_ids is None:
+                    deletes[variant] = [word_id]
+                else:
+                    word_ids.append(word_id)
+
+        variants = sorted(variant.encode('utf-8') for variant in deletes)
+        self.variant_data = b''.join(variants)
+        self.variant_offsets = np.cumsum([0] + [len(v) for v in variants], dtype=np.int64)
+        word_ids = [deletes[v.decode('utf-8')] for v in variants]
+        self.delete_offsets = np.cumsum([0] + [len(ids) for ids in word_ids], dtype=np.int64)
+        self.delete_word_ids = np.array([i for ids in word_ids for i in ids], dtype=np.int32)
+        self.added_deletes = {}
+        self._word_index = None
+
+    def add(self, word):
+        if len(word) < self.min_word_len():
+            return
+        if self._word_index is None:
+            self._word_index = {w: i for i, w in enumerate(self.words)}
+        # a removed word keeps its id, adding it again must not index it twice
+        if word in self._word_index:
+            return
+        word_id = len(self.words)
+        self.words.append(word)
+        self._word_index[word] = word_id
+        for variant in self._deletes(word[:self.prefix_length]):
+            self.added_deletes.setdefault(variant, []).append(word_id)
+
+    def _deletes(self, word):
+        variants = {word}
+        edge = {word}
+        for _ in range(self.max_distance):
+            edge = {w[:i] + w[i + 1:] for w in edge for i in range(len(w))}
+            variants |= edge
+        return variants
+
+    def _variant_word_ids(self, variant):
+        key = variant.encode('utf-8')
+        data, offsets = self.variant_data, self.variant_offsets
+        lo, hi = 0, len(offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(data[offsets[mid]:offsets[mid + 1]]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        word_ids = []
+        if lo < len(offsets) - 1 and bytes(data[offsets[lo]:offsets[lo + 1]]) == key:
+            word_ids = self.delete_word_ids[self.delete_offsets[lo]:self.delete_offsets[lo + 1]].tolist()
+        return word_ids + self.added_deletes.get(variant, [])
+
+    def find_candidates(self, prefix, max_candidates=5, limit_weight=8):
+        limit = self.trie._search_limit(prefix, limit_weight)
+        word_ids = set()
+        for variant in self._deletes(prefix[:self.prefix_length]):
+            word_ids.update(self._variant_word_ids(variant))
+
+        found = []
+        for word_id in word_ids:
+            word = self.words[word_id]
+            if abs(len(word) - len(prefix)) > self.max_distance:
+                continue
+            # removed from the language model after the index was built
+            if self.language_model.unigram_stat.get(word, 0) <= 0:
+                continue
+            error_weight = self.error_weight(prefix, word, limit)
+            if error_weight < limit:
+                found.append((error_weight, word))
+        found.sort()
+
+        candidates = {}
+        for error_weight, word in found[:max_candidates]:
+            candidates[word] = Candidate(word, self.language_model.unigram_weights[word], error_weight)
+        return candidates
+
+    def to_arrays(self):
+        """
+        The settings and the arrays of the built index, the words added later are not included
+        """
+        settings = {'max_distance': self.max_distance, 'prefix_length': self.prefix_length,
+                    'long_word_len': self.long_word_len, 'words_cnt': len(self.words)}
+        words = '\n'.join(self.words).encode('utf-8')
+        return settings, words, bytes(self.variant_data), self.variant_offsets, self.delete_offsets, \
+            self.delete_word_ids
+
+    @classmethod
+    def from_arrays(cls, trie, settings, words, variant_data, variant_offsets, delete_offsets, delete_word_ids):
+        """
+        An index over the arrays of to_arrays(), which may be views of a mapped file
+        """
+        index = cls(trie, settings['max_distance'], settings['prefix_length'], settings['long_word_len'])
+        words = bytes(words).decode('utf-8')
+        index.words = words.split('\n') if words else []
+        index.variant_data = variant_data
+        index.variant_offsets = variant_offsets
+        index.delete_offsets = delete_offsets
+        index.delete_word_ids = delete_word_ids
+        return index
+
+    def error_weight(self, prefix, word, limit=float('inf')):
+        """
+        Weighted Damerau-Levenshtein distance with the transitions of Trie.find_candidates:
+        substitution, insertion (duplication), deletion and transposition of adjacent letters.
+        Returns inf for words the trie search cannot reach or when every path exceeds limit.
+        """
+        inf = float('inf')
+        table = self.trie.cost_table()
+        char_ids = self.trie.char_ids
+        word_ids = [char_ids.get(c) for c in word]
+        if any(c is None or not table.allowed_row[c] for c in word_ids):
+            return inf
+        prefix_ids = [table.prefix_id(prefix, i) for i in range(len(prefix))]
+        insertion = table.insertion_row
+
+        prev_prev_row = None
+        prev_row = [0.0]
+        for j, w in enumerate(word_ids):
+            prev_row.append(prev_row[j] + insertion[w])
+        for i, p in enumerate(prefix_ids, 1):
+            substitution = table.substitution_rows[p]
+            row = [prev_row[0] + table.deletion_row[p]]
+            for j, w in enumerate(word_ids, 1):
+                weight = prev_row[j - 1] + (0.0 if p == w else substitution[w])
+                weight = min(weight, row[j - 1] + insertion[w], prev_row[j] + table.deletion_row[p])
+                if i > 1 and j > 1 and p != prefix_ids[i - 2] \
+                    and p == word_ids[j - 2] and prefix_ids[i - 2] == w:
+                    weight = min(weight, prev_prev_row[j - 2] + table.transposition)
+                row.append(weight)
+            # a transposition reaches the next row from prev_row
+            if min(row) >= limit and min(prev_row) + table.transposition >= limit:
+                return inf
+            prev_prev_row, prev_row = prev_row, row
+        return prev_row[-1]
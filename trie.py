@@ -1,11 +1,12 @@
 from dataclasses import dataclass, field
 from typing import Any
-from collections import deque, namedtuple
+from collections import deque, namedtuple, Counter
 import string
 from functools import reduce
 import operator
-from heapq import heappush, heappop
+from heapq import heappush, heappop, heapify, nsmallest, nlargest
 import re
+import time
 import util
 
 @dataclass(order=True)
@@ -15,6 +16,15 @@ class Transition:
     prefix: Any=field(compare=False)
     result: Any=field(compare=False)
 
+@dataclass(order=True)
+class AstarTransition:
+    priority : float
+    node: Any=field(compare=False)
+    weight : Any=field(compare=False)
+    prefix: Any=field(compare=False)
+    result: Any=field(compare=False)
+    final: bool=field(default=False, compare=False)
+
 @dataclass(order=True)
 class CacheCandidate:
     def __init__(self, word, f_lm, f_fix):
@@ -39,12 +49,73 @@ class Candidate:
     error_weight : Any=field(compare=False)
     weight : float
 
+class SearchStats:
+    """
+    Counters of one Trie.find_candidates search
+    """
+    def __init__(self, word):
+        self.word = word
+        self.pops = 0
+        self.pushes = 1 # the root transition
+        self.peak_queue = 1
+        self.pruned = 0 # transitions over limit_weight
+        self.hit_max_iters = False
+        self.over_queue_size = False
+        self.discarded = 0 # transitions dropped by the bounded search
+        self.candidates = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return 'SearchStats(' + ', '.join(k + '=' + str(v) for k, v in vars(self).items()) + ')'
+
+class SearchProfile:
+    """
+    Per-process histograms of SearchStats. Bucket b counts values in [2 ** (b - 1), 2 ** b),
+    bucket 0 counts zeros.
+    """
+    fields = ('pops', 'pushes', 'peak_queue', 'pruned', 'discarded', 'candidates')
+
+    def __init__(self):
+        self.searches = 0
+        self.max_iters_hits = 0
+        self.over_queue_size = 0
+        self.seconds = 0.0
+        self.histograms = {f: Counter() for f in self.fields}
+        self.time_histogram = Counter() # milliseconds
+
+    def add(self, stats):
+        self.searches += 1
+        self.max_iters_hits += stats.hit_max_iters
+        self.over_queue_size += stats.over_queue_size
+        self.seconds += stats.seconds
+        for f in self.fields:
+            self.histograms[f][getattr(stats, f).bit_length()] += 1
+        self.time_histogram[int(stats.seconds * 1000).bit_length()] += 1
+
+    def merge(self, other):
+        self.searches += other.searches
+        self.max_iters_hits += other.max_iters_hits
+        self.over_queue_size += other.over_queue_size
+        self.seconds += other.seconds
+        for f in self.fields:
+            self.histograms[f].update(other.histograms[f])
+        self.time_histogram.update(other.time_histogram)
+
+    def report(self):
+        lines = ['searches: ' + str(self.searches) + ', max_iters hits: ' + str(self.max_iters_hits)
+                 + ', over max_queue_size: ' + str(self.over_queue_size) + ', seconds: ' + str(round(self.seconds, 3))]
+        for name, histogram in list(self.histograms.items()) + [('ms', self.time_histogram)]:
+            buckets = ['<' + str(2 ** b) + ': ' + str(histogram[b]) for b in sorted(histogram)]
+            lines.append(name + ' ' + ', '.join(buckets))
+        return '\n'.join(lines)
+
 class Node:
     def __init__(self, value=None, lm_weight=None, end=False):
         self.end = end
         self.value = value
         self.lm_weight = lm_weight
         self.word = None
+        self.best_lm_weight = float('inf')
         self.children = {}
         self.max_candidates = 1
 
@@ -64,22 +135,104 @@ class Trie:
         self.limit_weight = 12
         self.max_queue_size = 100_000
         self.max_iters = 100_000
+        # keep at most max_queue_size transitions, dropping the worst ones
+        self.bounded = False
+        # False when the last search dropped transitions or stopped at max_iters
+        self.last_search_exact = True
+        # find candidates with the best-first search by 1.7 * lm_weight + error_weight
+        self.astar = False
+        # SearchProfile collecting SearchStats of every search, None disables the counters
+        self.search_profile = None
+        self.last_search_stats = None
+        # trie of the most frequent words searched first, see build_hot_tier
+        self.hot_tier = None
+        self.hot_tier_weight = None
+        self.tier_searches = Counter()
+        self.tier_hits = Counter()
+        # optional util.LRUCache of find_candidates results, cleared when the trie changes, see enable_cache
+        self.cache = None
+        self.version = 0
+        # node weights are stored without the shift of UnigramWeights, the shift is read when a search starts
+        self.weight_shift = 0.0
+        self._cache_version = 0
+
+        # char ids of trie letters, ErrorCostTable rows and columns are indexed by them
+        self.alphabet = []
+        self.char_ids = {}
+        self._cost_table = None
+
+    def _stored_weight(self, word):
+        return self.language_model.unigram_weights[word] - self.language_model.unigram_weight_shift()
 
     def add(self, word):
+        lm_weight = self._stored_weight(word)
         node = self._root
+        node.best_lm_weight = min(node.best_lm_weight, lm_weight)
         for part in word:
+            if part not in self.char_ids:
+                self.char_ids[part] = len(self.alphabet)
+                self.alphabet.append(part)
+                self._cost_table = None
             next_node = node.children.get(part)
             if next_node is None:
-                node.children[part] = Node(part)
-                node = node.children[part]
-            else:
-                node = next_node
+                next_node = Node(part)
+                node.children[part] = next_node
+            node = next_node
+            node.best_lm_weight = min(node.best_lm_weight, lm_weight)
 
         if not node.end:
             self.__len += 1
+            self.version += 1
             node.end = True
             node.word = word
-            node.lm_weight = self.language_model.unigram_weights[word]
+            node.lm_weight = lm_weight
+
+    def remove(self, word):
+        path = self._path(word)
+        if path is None or not path[-1].end:
+            return False
+        node = path[-1]
+        node.end = False
+        node.word = None
+        node.lm_weight = None
+        # drop the nodes left without words
+        for parent, part, child in reversed(list(zip(path, word, path[1:]))):
+            if child.end or child.children:
+                break
+            del parent.children[part]
+        self._refresh_best_lm_weight(path)
+        self.__len -= 1
+        self.version += 1
+        if self.hot_tier is not None:
+            self.hot_tier.remove(word)
+        return True
+
+    def update_weight(self, word):
+        path = self._path(word)
+        if path is None or not path[-1].end:
+            return False
+        path[-1].lm_weight = self._stored_weight(word)
+        self._refresh_best_lm_weight(path)
+        self.version += 1
+        if self.hot_tier is not None:
+            self.hot_tier.update_weight(word)
+        return True
+
+    def _path(self, word):
+        path = [self._root]
+        for part in word:
+            node = self._child(path[-1], part)
+            if node is None:
+                return None
+            path.append(node)
+        return path
+
+    def _refresh_best_lm_weight(self, path):
+        for node in reversed(path):
+            best = node.lm_weight if node.end else float('inf')
+            for child in node.children.values():
+                best = min(best, child.best_lm_weight)
+            node.best_lm_weight = best
 
     def add_candidate(self, new_cand, candidates):
         word = new_cand.word
@@ -96,86 +249,369 @@ class Trie:
                 #    candidates[word] = new_cand
                 #    del candidates[cand_with_max_weight.word]
         
+    def _search_limit(self, prefix, limit_weight):
+        return 14 if len(prefix) >= 5 else limit_weight
+
     def find_candidates(self, prefix, max_candidates=5, limit_weight=8):
-        if len(prefix) >= 5:
-            self.limit_weight = 14
+        return self._lookup(prefix, max_candidates, limit_weight, self._expand)
+
+    def find_candidates_batch(self, words, max_candidates=5, limit_weight=8):
+        """
+        Returns one candidates dict per word, as find_candidates does.
+        The words are searched in sorted order over frontiers of (node, position) states,
+        see _search_sorted, so words sharing a prefix share the frontiers of that prefix.
+        The search is exact: max_iters, bounded, the cache and the hot tier do not apply,
+        and of candidates with equal weights at the cut the ones kept may differ.
+        """
+        groups = {}
+        for word in set(words):
+            groups.setdefault(self._search_limit(word, limit_weight), []).append(word)
+        found = {}
+        for limit, group in groups.items():
+            for word, words_found in self._search_sorted(sorted(group), limit).items():
+                found[word] = self._select_candidates(words_found, max_candidates)
+        return [dict(found[word]) for word in words]
+
+    def _select_candidates(self, words_found, max_candidates):
+        # as many candidates as find_candidates keeps, by the weight its search orders them by
+        unigram_weights = self.language_model.unigram_weights
+        candidates = [Candidate(word, unigram_weights[word], error_weight) for word, error_weight in words_found.items()]
+        if self.astar:
+            candidates = sorted(candidates, key=lambda c: (c.weight, c.word))[:max_candidates]
         else:
-            self.limit_weight = limit_weight
+            candidates = sorted(candidates, key=lambda c: (c.error_weight, c.word))[:max_candidates + 1]
+        return {c.word: c for c in candidates}
+
+    def _search_sorted(self, words, limit):
+        """
+        {word: {trie word: least error weight}} of the trie words under limit, words must be sorted.
+        frontiers[i] maps the nodes reached by the first i letters of a word to (error weight, trie path).
+        It depends on those letters only, so the frontiers of the common prefix are kept for the next word.
+        """
+        found = {}
+        frontiers = [self._close_frontier({self._root: (0.0, '')}, limit)]
+        prev_word = ''
+        for word in words:
+            common = 0
+            while common < min(len(word), len(prev_word)) and word[common] == prev_word[common]:
+                common += 1
+            del frontiers[common + 1:]
+            for i in range(common, len(word)):
+                frontiers.append(self._next_frontier(frontiers, word, i, limit))
+            found[word] = {result: weight for node, (weight, result) in frontiers[-1].items() if self._is_end(node)}
+            prev_word = word
+        return found
+
+    def _next_frontier(self, frontiers, word, i, limit):
+        # the transitions of _expand consuming word[i], and the transpositions of word[i - 1] and word[i]
+        table = self.cost_table()
+        alphabet = self.alphabet
+        allowed = table.allowed_row
+        prefix_id = table.prefix_id(word, i)
+        substitution = table.substitution_rows[prefix_id]
+        deletion = table.deletion_row[prefix_id]
+        min_cost = table.min_cost[prefix_id]
+        frontier = {}
+        def relax(node, weight, result):
+            if weight < limit:
+                old = frontier.get(node)
+                if old is None or weight < old[0]:
+                    frontier[node] = (weight, result)
+
+        for node, (weight, result) in frontiers[i].items():
+            relax(node, weight + deletion, result)
+            if weight + min_cost < limit:
+                for char_id, next_node in self._edges(node):
+                    if allowed[char_id]:
+                        relax(next_node, weight + (0.0 if char_id == prefix_id else substitution[char_id]),
+                              result + alphabet[char_id])
+            elif prefix_id < len(alphabet) and allowed[prefix_id]:
+                # every error transition exceeds the limit, only the exact letter is left
+                next_node = self._child_by_id(node, prefix_id)
+                if next_node is not None:
+                    relax(next_node, weight, result + alphabet[prefix_id])
+
+        first_id = table.prefix_id(word, i - 1) if i > 0 else prefix_id
+        if first_id != prefix_id and first_id < len(alphabet) and prefix_id < len(alphabet) and allowed[prefix_id]:
+            for node, (weight, result) in frontiers[i - 1].items():
+                if weight + table.transposition < limit:
+                    next_node = self._child_by_id(node, prefix_id)
+                    swapped_node = self._child_by_id(next_node, first_id) if next_node is not None else None
+                    if swapped_node is not None:
+                        relax(swapped_node, weight + table.transposition,
+                              result + alphabet[prefix_id] + alphabet[first_id])
+        return self._close_frontier(frontier, limit)
+
+    def _close_frontier(self, frontier, limit):
+        # adds the nodes reached by inserted letters, which consume no letter of the word, cheapest first
+        table = self.cost_table()
+        alphabet = self.alphabet
+        allowed = table.allowed_row
+        insertion = table.insertion_row
+        queue = [(weight, k, node) for k, (node, (weight, _)) in enumerate(frontier.items())]
+        heapify(queue)
+        pushes = len(queue)
+        while queue:
+            weight, _, node = heappop(queue)
+            if weight + table.min_insertion >= limit:
+                break
+            curr_weight, result = frontier[node]
+            if weight > curr_weight:
+                continue
+            for char_id, next_node in self._edges(node):
+                if allowed[char_id]:
+                    next_weight = weight + insertion[char_id]
+                    if next_weight < limit:
+                        old = frontier.get(next_node)
+                        if old is None or next_weight < old[0]:
+                            frontier[next_node] = (next_weight, result + alphabet[char_id])
+                            pushes += 1
+                            heappush(queue, (next_weight, pushes, next_node))
+        return frontier
+
+    def enable_cache(self, capacity):
+        # capacity is the number of cached candidates, every entry costs at least 1
+        self.cache = util.LRUCache(capacity, sizeof=lambda item: len(item[0]) + 1)
+        self._cache_version = self.version
+
+    def _lookup(self, prefix, max_candidates, limit_weight, expand):
+        if self.cache is None:
+            return self._find_candidates(prefix, max_candidates, limit_weight, expand)
+        if self._cache_version != self.version:
+            self.cache.clear()
+            self._cache_version = self.version
+        key = (prefix, max_candidates, self._search_limit(prefix, limit_weight), self.astar, self.bounded)
+        item = self.cache.get(key)
+        if item is None:
+            item = (self._find_candidates(prefix, max_candidates, limit_weight, expand), self.last_search_exact)
+            self.cache.put(key, item)
+        candidates, self.last_search_exact = item
+        return dict(candidates)
+
+    def build_hot_tier(self, size, weight=6.0):
+        """
+        Builds a trie of the size most frequent words, searched before this one.
+        This trie is searched only if the hot tier finds no candidate with error weight under weight,
+        or if the searched word is a word of this trie but not of the hot tier.
+        """
+        unigram_stat = self.language_model.unigram_stat
+        words = nlargest(size, (w for w, cnt in unigram_stat.items() if cnt > 0), key=unigram_stat.get)
+        self.hot_tier = type(self)(self.error_model, self.language_model)
+        self.hot_tier.build(words)
+        self.hot_tier_weight = weight
+        self.version += 1
 
+    def tier_stats(self):
+        return {tier: {'searches': self.tier_searches[tier], 'hits': self.tier_hits[tier],
+                       'hit_rate': self.tier_hits[tier] / self.tier_searches[tier] if self.tier_searches[tier] else 0.0}
+                for tier in ('hot', 'full')}
+
+    def _find_candidates(self, prefix, max_candidates, limit_weight, expand):
+        if self.hot_tier is None:
+            return self._search(prefix, max_candidates, limit_weight, expand)
+        hot_tier = self.hot_tier
+        for attr in ('astar', 'bounded', 'max_iters', 'max_queue_size', 'search_profile'):
+            setattr(hot_tier, attr, getattr(self, attr))
+        candidates = hot_tier._find_candidates(prefix, max_candidates, limit_weight, hot_tier._expand)
+        self.tier_searches['hot'] += 1
+        # a correct word of the tail must not be replaced by a frequent neighbour
+        is_tail_word = prefix not in hot_tier and prefix in self
+        if not is_tail_word and any(c.error_weight < self.hot_tier_weight for c in candidates.values()):
+            self.tier_hits['hot'] += 1
+            self.last_search_exact = hot_tier.last_search_exact
+            return candidates
+        candidates = self._search(prefix, max_candidates, limit_weight, expand)
+        self.tier_searches['full'] += 1
+        self.tier_hits['full'] += len(candidates) > 0
+        return candidates
+
+    def _search(self, prefix, max_candidates, limit_weight, expand):
+        self.weight_shift = self.language_model.unigram_weight_shift()
+        self.limit_weight = self._search_limit(prefix, limit_weight)
         self.max_candidates = max_candidates
+        if self.search_profile is None:
+            if self.astar:
+                return self._find_candidates_astar(prefix, max_candidates, self.limit_weight, expand)
+            return self._find_candidates_best_error(prefix, self.limit_weight, expand)
+
+        stats = SearchStats(prefix)
+        expand = self._counting_expand(expand, stats)
+        start = time.perf_counter()
+        if self.astar:
+            candidates = self._find_candidates_astar(prefix, max_candidates, self.limit_weight, expand, stats)
+        else:
+            candidates = self._find_candidates_best_error(prefix, self.limit_weight, expand, stats)
+        stats.seconds = time.perf_counter() - start
+        stats.candidates = len(candidates)
+        stats.over_queue_size = stats.peak_queue > self.max_queue_size
+        self.last_search_stats = stats
+        self.search_profile.add(stats)
+        return candidates
+
+    def _find_candidates_best_error(self, prefix, limit, expand, stats=None):
         queue = []
         candidates = {}
-        heappush(queue, Transition(self._root, 0, prefix, ''))
+        def push(node, weight, next_prefix, result):
+            heappush(queue, Transition(node, weight, next_prefix, result))
+
+        push(self._root, 0, prefix, '')
         iter = 0
+        discarded = 0
         while len(queue) > 0 and iter < self.max_iters:
             iter += 1
+            if stats is not None and len(queue) > stats.peak_queue:
+                stats.peak_queue = len(queue)
             curr_transition = heappop(queue)
             # prefix is processed
             if len(curr_transition.prefix) == 0:
-                if curr_transition.node.end:
+                if self._is_end(curr_transition.node):
                     new_word = curr_transition.result
                     new_cand = Candidate(new_word, self.language_model.unigram_weights[new_word], curr_transition.weight)
                     self.add_candidate(new_cand, candidates)
+            expand(curr_transition.node, curr_transition.prefix, curr_transition.weight,
+                   curr_transition.result, limit, push)
+            if self.bounded and len(queue) > self.max_queue_size:
+                discarded += self._truncate_queue(queue)
 
-            prefix_letter = curr_transition.prefix[:1]
-            curr_weight = curr_transition.weight
-            for trie_letter, next_node  in curr_transition.node.children.items():
-                if trie_letter in (self.rus_letters + self.eng_letters):
-                    if trie_letter == prefix_letter:
-                        # add transition with null weight
-                        heappush(queue, Transition(next_node, curr_weight,  curr_transition.prefix[1:], 
-                                                   curr_transition.result + trie_letter))
-                        # add transition with duplication prefix_letter
-                        if prefix_letter in self.error_model.weights['']:
-                            additional_weight = self.error_model.weights[''][prefix_letter]
-                            if self.__transition_can_be_added(curr_weight + additional_weight, curr_transition):
-                                heappush(queue, Transition(next_node, curr_weight + additional_weight, 
-                                                           curr_transition.prefix, curr_transition.result + prefix_letter))
-                    else:
-                        if trie_letter in self.error_model.weights[prefix_letter]:
-                            # add transition with replacing prefix_letter -> trie_letter
-                            additional_weight = self.error_model.weights[prefix_letter][trie_letter]
-                            # similar symbol
-                            if prefix_letter != '' and trie_letter in self.similar_symbols \
-                                and self.similar_symbols[trie_letter] == ord(prefix_letter):
-                                additional_weight = 0.5
-                            if self.__transition_can_be_added(curr_weight + additional_weight, curr_transition):
-                                heappush(queue, Transition(next_node, curr_weight + additional_weight, 
-                                                           curr_transition.prefix[1:], 
-                                                           curr_transition.result + trie_letter))
-                        # add transition with insert miss letters
-                        if trie_letter in self.error_model.weights['']:
-                            additional_weight = self.error_model.weights[''][trie_letter]
-                            if self.__transition_can_be_added(curr_weight + additional_weight, curr_transition):
-                                transition = Transition(next_node, curr_weight + additional_weight,
-                                                        curr_transition.prefix,
-                                                        curr_transition.result + trie_letter)
-                                heappush(queue, transition)
-
-                    # add transition with transposition (df -> fd)
-                    if len(curr_transition.prefix) > 1:
-                        if trie_letter == curr_transition.prefix[1] and prefix_letter in next_node.children \
-                            and trie_letter != prefix_letter:
-                            additional_weight = 4.0 # penalty for transposition
-                            if self.__transition_can_be_added(curr_weight + additional_weight, curr_transition):
-                                transition = Transition(next_node.children[prefix_letter], curr_weight + additional_weight, 
-                                                        curr_transition.prefix[2:], 
-                                                        curr_transition.result + trie_letter + prefix_letter)
-                                heappush(queue, transition)
-                    
-                    #self.__add_transition_translit(queue, candidates, currcurr_transition, next_node)  
-                                
-            if '' in self.error_model.weights[prefix_letter]:
-                # add transition with deletion current letter
-                additional_weight = self.error_model.weights[prefix_letter]['']
-                if self.__transition_can_be_added(curr_weight + additional_weight, curr_transition):
-                    transition = Transition(curr_transition.node, curr_weight + additional_weight, 
-                                            curr_transition.prefix[1:], curr_transition.result)
-                    heappush(queue, transition)
-            continue
+        hit_max_iters = len(queue) > 0 and iter >= self.max_iters
+        self.last_search_exact = discarded == 0 and not hit_max_iters
+        if stats is not None:
+            stats.pops = iter
+            stats.hit_max_iters = hit_max_iters
+            stats.discarded = discarded
+        return candidates
 
+    def _find_candidates_astar(self, prefix, max_candidates, limit, expand, stats=None):
+        """
+        Best-first search by the final candidate weight: the error weight so far plus
+        the best unigram weight reachable below the node. Both parts never decrease along a path,
+        so candidates come out of the queue in order and the search stops after max_candidates.
+        """
+        queue = []
+        candidates = {}
+        expanded = set()
+        def push(node, weight, next_prefix, result):
+            heappush(queue, AstarTransition(1.7 * self._best_lm_weight(node) + weight,
+                                            node, weight, next_prefix, result))
+
+        push(self._root, 0, prefix, '')
+        iter = 0
+        discarded = 0
+        while len(queue) > 0 and iter < self.max_iters and len(candidates) < max_candidates:
+            iter += 1
+            if stats is not None and len(queue) > stats.peak_queue:
+                stats.peak_queue = len(queue)
+            curr_transition = heappop(queue)
+            if curr_transition.final:
+                word = curr_transition.result
+                candidates[word] = Candidate(word, self._lm_weight(curr_transition.node), curr_transition.weight)
+                continue
+            # the trie path defines the result, so a node with the same rest of prefix is expanded once
+            state = (curr_transition.node, len(curr_transition.prefix))
+            if state in expanded:
+                continue
+            expanded.add(state)
+            if len(curr_transition.prefix) == 0 and self._is_end(curr_transition.node):
+                lm_weight = self._lm_weight(curr_transition.node)
+                heappush(queue, AstarTransition(1.7 * lm_weight + curr_transition.weight, curr_transition.node,
+                                                curr_transition.weight, '', curr_transition.result, True))
+                if stats is not None:
+                    stats.pushes += 1
+            expand(curr_transition.node, curr_transition.prefix, curr_transition.weight,
+                   curr_transition.result, limit, push)
+            if self.bounded and len(queue) > self.max_queue_size:
+                discarded += self._truncate_queue(queue)
+
+        hit_max_iters = len(queue) > 0 and iter >= self.max_iters and len(candidates) < max_candidates
+        self.last_search_exact = discarded == 0 and not hit_max_iters
+        if stats is not None:
+            stats.pops = iter
+            stats.hit_max_iters = hit_max_iters
+            stats.discarded = discarded
         return candidates
 
+    def _truncate_queue(self, queue):
+        # keep the better half, a sorted list is a valid heap
+        kept = nsmallest(self.max_queue_size // 2, queue)
+        discarded = len(queue) - len(kept)
+        queue[:] = kept
+        return discarded
+
+    def _counting_expand(self, expand, stats):
+        # expands without a limit and applies it in push, so the pruned transitions can be counted
+        def counting_expand(node, curr_prefix, curr_weight, result, limit, push):
+            def counting_push(next_node, weight, next_prefix, next_result):
+                if weight < limit:
+                    stats.pushes += 1
+                    push(next_node, weight, next_prefix, next_result)
+                else:
+                    stats.pruned += 1
+            expand(node, curr_prefix, curr_weight, result, float('inf'), counting_push)
+        return counting_expand
+
+    def _expand(self, node, curr_prefix, curr_weight, result, limit, push):
+        table = self.cost_table()
+        alphabet = self.alphabet
+        allowed = table.allowed_row
+        insertion = table.insertion_row
+        prefix_id = table.prefix_id(curr_prefix)
+        next_id = table.prefix_id(curr_prefix, 1)
+        prefix_rest = curr_prefix[1:]
+        if curr_weight + table.min_cost[prefix_id] < limit:
+            substitution = table.substitution_rows[prefix_id]
+            for char_id, next_node in self._edges(node):
+                if not allowed[char_id]:
+                    continue
+                trie_letter = alphabet[char_id]
+                if char_id == prefix_id:
+                    # add transition with null weight
+                    push(next_node, curr_weight, prefix_rest, result + trie_letter)
+                    # add transition with duplication prefix_letter
+                    weight = curr_weight + insertion[char_id]
+                    if weight < limit:
+                        push(next_node, weight, curr_prefix, result + trie_letter)
+                else:
+                    # add transition with replacing prefix_letter -> trie_letter
+                    weight = curr_weight + substitution[char_id]
+                    if weight < limit:
+                        push(next_node, weight, prefix_rest, result + trie_letter)
+                    # add transition with insert miss letters
+                    weight = curr_weight + insertion[char_id]
+                    if weight < limit:
+                        push(next_node, weight, curr_prefix, result + trie_letter)
+                if char_id == next_id:
+                    self.__add_transposition(next_node, curr_prefix, curr_weight, result,
+                                             prefix_id, next_id, limit, push)
+        else:
+            # every error transition exceeds the limit, only the exact letter and transposition are left
+            children = [(char_id, self._child_by_id(node, char_id)) for char_id in {prefix_id, next_id}
+                        if char_id < len(alphabet) and allowed[char_id]]
+            children = [(char_id, next_node) for char_id, next_node in children if next_node is not None]
+            if len(children) == 2:
+                # in the order of _edges, as the full loop above visits them
+                children.sort(key=lambda item: self._child_rank(node, item[0]))
+            for char_id, next_node in children:
+                if char_id == prefix_id:
+                    push(next_node, curr_weight, prefix_rest, result + alphabet[char_id])
+                if char_id == next_id:
+                    self.__add_transposition(next_node, curr_prefix, curr_weight, result,
+                                             prefix_id, next_id, limit, push)
+
+        # add transition with deletion current letter
+        weight = curr_weight + table.deletion_row[prefix_id]
+        if weight < limit:
+            push(node, weight, prefix_rest, result)
+
+    def __add_transposition(self, next_node, curr_prefix, curr_weight, result, prefix_id, next_id, limit, push):
+        # add transition with transposition (df -> fd)
+        if next_id == prefix_id or prefix_id >= len(self.alphabet):
+            return
+        weight = curr_weight + self.cost_table().transposition
+        if weight < limit:
+            swapped_node = self._child_by_id(next_node, prefix_id)
+            if swapped_node is not None:
+                push(swapped_node, weight, curr_prefix[2:], result + self.alphabet[next_id] + self.alphabet[prefix_id])
+
     def __transition_can_be_added(self, weight, curr_transition):
         return weight < self.limit_weight
         #return weight < self.limit_weight and len(candidates) < self.max_candidates \
@@ -197,23 +633,71 @@ class Trie:
                 heappush(queue, Transition(child, curr_weight + additional_weight, 
                                            curr_transition.prefix[1:], curr_transition.result + trie_letter))
 
+    def cost_table(self):
+        if self._cost_table is None:
+            self._cost_table = self.error_model.cost_table(self.alphabet, self.similar_symbols,
+                                                           set(self.rus_letters + self.eng_letters))
+        return self._cost_table
+
+    def _edges(self, node):
+        return zip(map(self.char_ids.__getitem__, node.children.keys()), node.children.values())
+
+    def _child(self, node, letter):
+        return node.children.get(letter)
+
+    def _child_by_id(self, node, char_id):
+        return node.children.get(self.alphabet[char_id])
+
+    def _child_rank(self, node, char_id):
+        # position of the child in _edges(node), children are visited in insertion order
+        return list(node.children).index(self.alphabet[char_id])
+
+    def _is_end(self, node):
+        return node.end
+
+    def _lm_weight(self, node):
+        return node.lm_weight + self.weight_shift
+
+    def _best_lm_weight(self, node):
+        return node.best_lm_weight + self.weight_shift
+
     def _find(self, key):
         node = self._root
         for part in key:
-            node = node.children.get(part)
+            node = self._child(node, part)
             if node is None:
                 break
         return node
 
     def __contains__(self, key):
         node = self._find(key)
-        return node is not None and node.end
+        return node is not None and self._is_end(node)
+
+    def prefix_ends(self, text, start=0):
+        """
+        Ends of the words of the trie starting at text[start], in increasing order.
+        One walk down the trie, so the cost is bounded by the longest word.
+        """
+        ends = []
+        node = self._root
+        for end in range(start, len(text)):
+            node = self._child(node, text[end])
+            if node is None:
+                break
+            if self._is_end(node):
+                ends.append(end + 1)
+        return ends
 
     def __len__(self):
         return self.__len
 
-    def build(self):
-        correct_words = list(self.language_model.unigram_stat.keys())
+    def build(self, words=None):
+        if words is None:
+            words = (w for w, cnt in self.language_model.unigram_stat.items() if cnt > 0)
+        correct_words = list(words)
+        self.alphabet = sorted(set(''.join(correct_words)))
+        self.char_ids = {c: i for i, c in enumerate(self.alphabet)}
+        self._cost_table = None
         for word in correct_words:
             self.add(word)
 
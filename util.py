@@ -1,16 +1,180 @@
 import nltk_util
 import pickle
+import numpy as np
 import operator
+from collections import OrderedDict
 
 def save_obj(obj, name):
-    p = pickle.Pickler(open(name + '.pkl', 'wb'))
-    p.fast = True
-    p.dump(obj)
+    with open(name + '.pkl', 'wb') as f:
+        p = pickle.Pickler(f)
+        p.fast = True
+        p.dump(obj)
 
 def load_obj(name):                                                            
     with open(name + '.pkl', 'rb') as f:                                        
         return pickle.load(f)
 
+class LRUCache:
+    """
+    Bounded mapping that evicts least recently used items.
+    sizeof gives the size of a value, the sum of sizes is kept under capacity.
+    """
+    def __init__(self, capacity, sizeof=None):
+        self.capacity = capacity
+        self.sizeof = sizeof if sizeof is not None else (lambda value: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._items.move_to_end(key)
+        return item[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.capacity:
+            return
+        old_item = self._items.pop(key, None)
+        if old_item is not None:
+            self.size -= old_item[1]
+        self._items[key] = (value, size)
+        self.size += size
+        while self.size > self.capacity:
+            _, (_, evicted_size) = self._items.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        self._items.clear()
+        self.size = 0
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'items': len(self._items), 'size': self.size, 'capacity': self.capacity}
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+class QuantizedArray:
+    """
+    Read-only array of 8 or 16-bit codes into a dequantization table of float32 levels.
+    The levels are quantiles of the values, exact zeros stay zero.
+    """
+    def __init__(self, values, bits=8):
+        values = np.asarray(values, dtype=np.float32)
+        levels_cnt = 2 ** bits
+        if len(values) > 0:
+            levels = np.quantile(values, (np.arange(levels_cnt) + 0.5) / levels_cnt)
+            if (values == 0).any():
+                levels[np.argmin(np.abs(levels))] = 0.0
+            levels = np.unique(levels.astype(np.float32))
+        else:
+            levels = np.zeros(1, dtype=np.float32)
+        # nearest level, the bounds are the midpoints between levels
+        bounds = (levels[1:] + levels[:-1]) / 2
+        self.codes = np.searchsorted(bounds, values).astype(np.uint8 if bits <= 8 else np.uint16)
+        self.table = levels
+
+    def __getitem__(self, i):
+        return self.table[self.codes[i]]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def tolist(self):
+        return self.table[self.codes].tolist()
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.table.nbytes
+
+class NllMemo:
+    """
+    Memo of evaluate_words_nll results in front of a language model, set as its nll_memo attribute.
+    It serves whole sequences scored by stat_clf and stat_clf_batch, the candidate requests of a correction.
+    The decoders and segment_text score single transitions with transition_nll, which is
+    a few dict lookups and is not memoized.
+    Keys are tuples of word ids, unknown words share id -1 as they score the same,
+    models without word ids are keyed on the words.
+    The request memo is cleared by start_request(), with capacity the results are also kept
+    across requests in a process wide LRUCache.
+    """
+    def __init__(self, capacity=None):
+        self.request_memo = {}
+        self.process_memo = LRUCache(capacity) if capacity else None
+        self.request_hits = 0
+        self.process_hits = 0
+        self.misses = 0
+
+    def start_request(self):
+        self.request_memo.clear()
+
+    def clear(self):
+        self.request_memo.clear()
+        if self.process_memo is not None:
+            self.process_memo.clear()
+
+    def key(self, words, language_model, smoothing):
+        word_ids = getattr(language_model, 'word_ids', None)
+        if word_ids is None:
+            return (smoothing,) + tuple(w.lower() for w in words)
+        return (smoothing,) + tuple(word_ids.get(w.lower(), -1) for w in words)
+
+    def get(self, key):
+        nll = self.request_memo.get(key)
+        if nll is not None:
+            self.request_hits += 1
+            return nll
+        if self.process_memo is not None:
+            nll = self.process_memo.get(key)
+            if nll is not None:
+                self.process_hits += 1
+                self.request_memo[key] = nll
+                return nll
+        self.misses += 1
+        return None
+
+    def put(self, key, nll):
+        self.request_memo[key] = nll
+        if self.process_memo is not None:
+            self.process_memo.put(key, nll)
+
+    def evaluate(self, words, language_model, smoothing=True):
+        key = self.key(words, language_model, smoothing)
+        nll = self.get(key)
+        if nll is None:
+            nll = _evaluate_words_nll(words, language_model, smoothing)
+            self.put(key, nll)
+        return nll
+
+    def evaluate_batch(self, words_list, language_model, smoothing=True):
+        keys = [self.key(words, language_model, smoothing) for words in words_list]
+        nlls = np.array([self.get(key) for key in keys], dtype=float)
+        missed = np.flatnonzero(np.isnan(nlls))
+        if len(missed) > 0:
+            nlls[missed] = _evaluate_words_nll_batch([words_list[i] for i in missed], language_model, smoothing)
+            for i in missed:
+                self.put(keys[i], float(nlls[i]))
+        return nlls
+
+    def stats(self):
+        requests = self.request_hits + self.process_hits + self.misses
+        return {'request_hits': self.request_hits, 'process_hits': self.process_hits, 'misses': self.misses,
+                'hit_rate': (self.request_hits + self.process_hits) / requests if requests else 0.0,
+                'items': len(self.process_memo) if self.process_memo is not None else len(self.request_memo)}
+
 def evaluate_pair_words_nll(curr_words, next_words, language_model):
     best_pair = []
     l_best_pair = float("inf")
@@ -41,27 +205,112 @@ def evaluate_pair_candidates_nll(curr, next, language_model):
     return best_pair
 
 def evaluate_words_nll(words, language_model, smoothing=True):
+    memo = getattr(language_model, 'nll_memo', None)
+    if memo is not None:
+        return memo.evaluate(words, language_model, smoothing)
+    return _evaluate_words_nll(words, language_model, smoothing)
+
+def _evaluate_words_nll(words, language_model, smoothing=True):
     words = [w.lower() for w in words]
     negative_log_p0 = 1_000
     if len(words) == 0: return negative_log_p0
     l_req = 0
-    if language_model.unigram_stat[words[0]] > 0:
-        l_req += language_model.unigram_weights[words[0]]
-    else:
-        l_req += language_model.unigram_def_value if smoothing else negative_log_p0
-    for i, word in enumerate(words[1:]):
-        if language_model.unigram_stat[words[i]] == 0:
-            l_req += language_model.unigram_def_value if smoothing else negative_log_p0
-        else:
-            if language_model.bigram_weights[words[i]][word] == 0:
-                if language_model.unigram_stat[word] > 0:
-                    l_req += language_model.unigram_weights[word]
-                else:
-                    l_req += language_model.unigram_def_value if smoothing else negative_log_p0
-            else:
-                l_req += language_model.bigram_weights[words[i]][word]
+    prev_word = None
+    for word in words:
+        l_req += transition_nll(prev_word, word, language_model, smoothing)
+        prev_word = word
     return l_req
 
+def transition_nll(prev_word, word, language_model, smoothing=True):
+    """
+    The term of word in evaluate_words_nll, prev_word is None for the first word.
+    Both words must be lowercase.
+    """
+    negative_log_p0 = 1_000
+    if prev_word is None:
+        if language_model.unigram_stat[word] > 0:
+            return language_model.unigram_weights[word]
+        return language_model.unigram_def_value if smoothing else negative_log_p0
+    if language_model.unigram_stat[prev_word] == 0:
+        return language_model.unigram_def_value if smoothing else negative_log_p0
+    bigram_weight = language_model.bigram_weights[prev_word][word]
+    if bigram_weight == 0:
+        if language_model.unigram_stat[word] > 0:
+            return language_model.unigram_weights[word]
+        return language_model.unigram_def_value if smoothing else negative_log_p0
+    return bigram_weight
+
+def evaluate_words_nll_batch(words_list, language_model, smoothing=True):
+    """
+    evaluate_words_nll of many word sequences at once.
+    With a CompactLanguageModel the sequences are a padded matrix of word ids scored in a few numpy passes
+    over the model arrays, other models score them one by one.
+    """
+    memo = getattr(language_model, 'nll_memo', None)
+    if memo is not None:
+        return memo.evaluate_batch(words_list, language_model, smoothing)
+    return _evaluate_words_nll_batch(words_list, language_model, smoothing)
+
+def _evaluate_words_nll_batch(words_list, language_model, smoothing=True):
+    if not hasattr(language_model, 'bigram_keys'):
+        return np.array([_evaluate_words_nll(words, language_model, smoothing) for words in words_list], dtype=float)
+    negative_log_p0 = 1_000
+    unknown_weight = language_model.unigram_def_value if smoothing else negative_log_p0
+    lengths = np.array([len(words) for words in words_list], dtype=np.int64)
+    width = max(1, int(lengths.max(initial=0)))
+    word_ids = language_model.word_ids
+    # -1 for unknown words and padding
+    ids = np.full((len(words_list), width), -1, dtype=np.int64)
+    for i, words in enumerate(words_list):
+        ids[i, :len(words)] = [word_ids.get(w.lower(), -1) for w in words]
+
+    total = _transition_nll_ids(None, ids[:, 0], language_model, unknown_weight)
+    if width > 1:
+        step = _transition_nll_ids(ids[:, :-1], ids[:, 1:], language_model, unknown_weight)
+        # column by column, so the sums are added in the order of evaluate_words_nll
+        for j in range(width - 1):
+            total += np.where(j + 1 < lengths, step[:, j], 0.0)
+    total[lengths == 0] = negative_log_p0
+    return total
+
+def _transition_nll_ids(prev_ids, ids, language_model, unknown_weight):
+    """
+    transition_nll over arrays of CompactLanguageModel word ids, -1 for unknown words.
+    prev_ids is None for first words, otherwise it is broadcast with ids.
+    """
+    unigram = np.asarray(language_model.unigram_weight_array[np.maximum(ids, 0)], dtype=np.float64)
+    unigram = np.where(ids >= 0, unigram, unknown_weight)
+    if prev_ids is None:
+        return unigram
+    prev_ids, ids, unigram = np.broadcast_arrays(prev_ids, ids, unigram)
+    bigram_keys = language_model.bigram_keys()
+    bigram = np.zeros(ids.shape, dtype=np.float64)
+    if len(bigram_keys) > 0:
+        keys = prev_ids * len(language_model.word_ids) + ids
+        pos = np.minimum(np.searchsorted(bigram_keys, keys), len(bigram_keys) - 1)
+        found = (prev_ids >= 0) & (ids >= 0) & (bigram_keys[pos] == keys)
+        bigram = np.where(found, np.asarray(language_model.bigram_weight_array[pos], dtype=np.float64), 0.0)
+    # a zero bigram weight means no bigram, as in evaluate_words_nll
+    return np.where(prev_ids < 0, unknown_weight, np.where(bigram != 0, bigram, unigram))
+
+def transition_nll_matrix(prev_words, words, language_model, smoothing=True):
+    """
+    transition_nll of every pair as a len(prev_words) x len(words) matrix, prev_words=None gives
+    the vector of first word terms. Vectorized over the arrays of CompactLanguageModel.
+    """
+    if not hasattr(language_model, 'bigram_keys'):
+        if prev_words is None:
+            return np.array([transition_nll(None, w, language_model, smoothing) for w in words], dtype=float)
+        return np.array([[transition_nll(p, w, language_model, smoothing) for w in words] for p in prev_words],
+                        dtype=float).reshape(len(prev_words), len(words))
+    unknown_weight = language_model.unigram_def_value if smoothing else 1_000
+    word_ids = language_model.word_ids
+    ids = np.array([word_ids.get(w, -1) for w in words], dtype=np.int64)
+    if prev_words is None:
+        return _transition_nll_ids(None, ids, language_model, unknown_weight)
+    prev_ids = np.array([word_ids.get(w, -1) for w in prev_words], dtype=np.int64)
+    return _transition_nll_ids(prev_ids[:, None], ids[None, :], language_model, unknown_weight)
+
 def evaluate_req_nll(request, language_model, smoothing=True):
     words = request.split()
     return evaluate_words_nll(words, language_model, smoothing)